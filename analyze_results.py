@@ -1,32 +1,176 @@
-from utils import parse_path
-from glob import glob
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import argparse
 import pandas as pd
+from utils import parse_path, search_file_paths
+
+'''
+Incremental analysis of the LLM judge reports. Every finding in every ai_eval.json under results/ is kept as one row of a
+flat table in cache/findings.db. A run only re-reads the reports whose mtime/size changed (and whose checksum then
+differs), and only recomputes the cross-run concept variance of the (idx, prompt) groups those reports belong to before
+writing missing_clinical_concepts.json and added_clinical_concepts.json.
+
+    python analyze_results.py            # fold new or changed reports in
+    python analyze_results.py --rebuild  # start from an empty table
+'''
+RESULTS_DIR = 'results'
+FINDINGS_PATH = os.path.join('cache', 'findings.db') # rebuilt from the reports, so kept with the other caches rather than in results/
+KINDS = ['missing', 'added']
+
+
+def checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class FindingsTable:
+    def __init__(self, path=FINDINGS_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, checksum TEXT
+            );
+            CREATE TABLE IF NOT EXISTS reports (
+                path TEXT, report INTEGER, idx INTEGER, model TEXT, prompt TEXT, timestamp TEXT,
+                judge_model TEXT, standard_note_path TEXT, n_added INTEGER, n_missing INTEGER,
+                PRIMARY KEY (path, report)
+            );
+            CREATE TABLE IF NOT EXISTS findings (
+                path TEXT, report INTEGER, position INTEGER, idx INTEGER, model TEXT, prompt TEXT, timestamp TEXT, kind TEXT,
+                clinical_concept TEXT, category TEXT, severity TEXT, confidence REAL, finding TEXT
+            );
+            CREATE TABLE IF NOT EXISTS variance (
+                kind TEXT, idx INTEGER, prompt TEXT, concepts TEXT,
+                PRIMARY KEY (kind, idx, prompt)
+            );
+            CREATE INDEX IF NOT EXISTS findings_path ON findings (path);
+            CREATE INDEX IF NOT EXISTS findings_group ON findings (idx, prompt, kind);
+            CREATE INDEX IF NOT EXISTS reports_group ON reports (idx, prompt);
+        ''')
+
+    def clear(self):
+        with self.lock:
+            for table in ('files', 'reports', 'findings', 'variance'):
+                self.conn.execute(f'DELETE FROM {table}')
+
+    def groups_of(self, path):
+        return set(self.conn.execute('SELECT DISTINCT idx, prompt FROM reports WHERE path = ?', (path,)).fetchall())
+
+    def remove(self, path):
+        for table in ('files', 'reports', 'findings'):
+            self.conn.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+
+    def add(self, path, stat, digest):
+        '''Replaces the rows of the report file at path. Returns the (idx, prompt) groups it touched.'''
+        path_data = parse_path(path, include_full_path=False)
+        key = (path_data['idx'], path_data['model'], path_data['prompt'], path_data['timestamp'])
+        with open(path, 'r') as f:
+            reports = json.load(f)
+        report_rows, finding_rows = [], []
+        for report, data in enumerate(reports):
+            report_rows.append((path, report, *key, data.get('model'), data.get('standard_note_path'), len(data.get('added') or []), len(data.get('missing') or [])))
+            for kind in KINDS:
+                for position, finding in enumerate(data.get(kind) or []):
+                    finding_rows.append((path, report, position, *key, kind, finding.get('clinical_concept'), finding.get('category'),
+                                         finding.get('severity'), finding.get('confidence'), json.dumps(finding)))
+        self.remove(path)
+        self.conn.execute('INSERT INTO files VALUES (?, ?, ?, ?)', (path, stat.st_mtime_ns, stat.st_size, digest))
+        self.conn.executemany('INSERT INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', report_rows)
+        self.conn.executemany('INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', finding_rows)
+        return {(path_data['idx'], path_data['prompt'])}
+
+    def update(self, paths):
+        '''
+        Folds the report files in paths into the table. Files with an unchanged mtime and size are skipped without being read,
+        files whose checksum is unchanged are not re-parsed, and files no longer in paths are dropped.
+        Returns the (idx, prompt) groups whose findings changed.
+        '''
+        changed = set()
+        with self.lock:
+            known = {path: (mtime_ns, size, digest) for path, mtime_ns, size, digest in self.conn.execute('SELECT * FROM files')}
+            self.conn.execute('BEGIN')
+            for path in paths:
+                stat = os.stat(path)
+                previous = known.pop(path, None)
+                if previous and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                digest = checksum(path)
+                if previous and previous[2] == digest:
+                    self.conn.execute('UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?', (stat.st_mtime_ns, stat.st_size, path))
+                    continue
+                changed |= self.groups_of(path) | self.add(path, stat, digest)
+            for path in known:
+                changed |= self.groups_of(path)
+                self.remove(path)
+            self.conn.execute('COMMIT')
+        return changed
+
+    def concepts(self, kind, idx, prompt):
+        '''Distinct clinical concepts reported across the runs of one group, in run order. A report with no findings counts as None.'''
+        reports = self.conn.execute(f'SELECT path, report, n_{kind} FROM reports WHERE idx = ? AND prompt = ? ORDER BY timestamp, path, report', (idx, prompt)).fetchall()
+        findings = {}
+        for path, report, concept in self.conn.execute('SELECT path, report, clinical_concept FROM findings WHERE idx = ? AND prompt = ? AND kind = ? ORDER BY position', (idx, prompt, kind)):
+            findings.setdefault((path, report), []).append(concept)
+        concepts = {}
+        for path, report, count in reports:
+            for concept in findings.get((path, report), []) if count else [None]:
+                concepts.setdefault(concept, None)
+        return list(concepts)
+
+    def refresh_variance(self, groups):
+        '''Recomputes the variance rows of groups; a group is kept only if its runs disagree on at least two concepts.'''
+        with self.lock:
+            self.conn.execute('BEGIN')
+            for idx, prompt in groups:
+                for kind in KINDS:
+                    self.conn.execute('DELETE FROM variance WHERE kind = ? AND idx = ? AND prompt = ?', (kind, idx, prompt))
+                    concepts = self.concepts(kind, idx, prompt)
+                    if len(concepts) > 1:
+                        self.conn.execute('INSERT INTO variance VALUES (?, ?, ?, ?)', (kind, idx, prompt, json.dumps(concepts)))
+            self.conn.execute('COMMIT')
+
+    def variance(self, kind):
+        with self.lock:
+            rows = self.conn.execute('SELECT idx, prompt, concepts FROM variance WHERE kind = ? ORDER BY idx, prompt', (kind,)).fetchall()
+        return pd.DataFrame([(idx, prompt, json.loads(concepts)) for idx, prompt, concepts in rows], columns=['idx', 'prompt', f'{kind}_clinical_concepts'])
+
+    def load_findings(self):
+        '''The flat findings table: one row per reported concept with its idx/model/prompt/timestamp.'''
+        with self.lock:
+            return pd.read_sql_query('SELECT idx, model, prompt, timestamp, path, report, kind, clinical_concept, category, severity, confidence FROM findings ORDER BY rowid', self.conn)
+
+    def close(self):
+        self.conn.close()
+
+
+def analyze(table, results_dir=RESULTS_DIR):
+    '''Brings table up to date with the ai_eval.json files under results_dir and writes the concept variance reports. Returns the changed groups.'''
+    changed = table.update(search_file_paths(filename='ai_eval.json', results_dir_path=results_dir))
+    table.refresh_variance(changed)
+    for kind in KINDS:
+        table.variance(kind).to_json(f'{kind}_clinical_concepts.json', orient='records', indent=4)
+    return changed
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Report clinical concepts that vary across judge runs of the same idx and prompt.')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--findings', default=FINDINGS_PATH)
+    parser.add_argument('--rebuild', action='store_true', help='re-read every report instead of only new or changed ones')
+    args = parser.parse_args(argv)
+    table = FindingsTable(args.findings)
+    if args.rebuild:
+        table.clear()
+    print(f'{len(analyze(table, args.results_dir))} (idx, prompt) groups updated')
 
 
 if __name__ == '__main__':
-    df = []
-
-    for path in glob('**/ai_eval.json', recursive=True):
-        path_data = parse_path(path)
-        df.append(pd.read_json(path).assign(**path_data))
-
-    df = pd.concat(df, ignore_index=True)
-    missing = pd.concat((df['full_path'].str.replace('ai_eval.json', 'gen_note.txt'), df['idx'], df['prompt'], pd.json_normalize(df['missing'].explode())), axis=1)
-    added = pd.concat((df['full_path'].str.replace('ai_eval.json', 'gen_note.txt'), df['idx'], df['prompt'], pd.json_normalize(df['added'].explode())), axis=1)
-
-    #look for differences between missing clinical concepts across runs for each prompt, idx combination
-    missing_clinical_concepts = []
-    for (idx, prompt), group in missing.groupby(['idx', 'prompt']):
-        if len(group['clinical_concept'].explode().unique()) > 1:
-            missing_clinical_concepts.append((idx, prompt, group['clinical_concept'].explode().unique().tolist()))
-    missing_clinical_concepts = pd.DataFrame(missing_clinical_concepts, columns=['idx', 'prompt', 'missing_clinical_concepts'])
-    missing_clinical_concepts.to_json('missing_clinical_concepts.json', orient='records', indent=4)
-
-    #look for differences between added clinical concepts across runs for each prompt, idx combination
-    added_clinical_concepts = []
-    for (idx, prompt), group in added.groupby(['idx', 'prompt']):
-        if len(group['clinical_concept'].explode().unique()) > 1:
-            added_clinical_concepts.append((idx, prompt, group['clinical_concept'].explode().unique().tolist()))
-
-    added_clinical_concepts = pd.DataFrame(added_clinical_concepts, columns=['idx', 'prompt', 'added_clinical_concepts'])
-    added_clinical_concepts.to_json('added_clinical_concepts.json', orient='records', indent=4)
+    main()
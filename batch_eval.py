@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import argparse
+from tqdm import tqdm
+
+'''
+Offline LLM judge using the OpenAI Batch API. Pending (standard, generated) comparisons are written to a JSONL batch file,
+submitted, polled until the batch finishes, and the report_added_doc/report_missing_doc tool calls in the results are
+written back to ai_eval.json. The submit/poll client is swappable: OpenAIBatchClient talks to the API, LocalBatchClient
+answers every request locally so the mode can be exercised without network access.
+'''
+BATCH_DIR = 'batches'
+MAX_BATCH_REQUESTS = 50000 # requests allowed in a single OpenAI batch
+FINISHED_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class OpenAIBatchClient:
+    def __init__(self, client, completion_window='24h'):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, batch_path):
+        with open(batch_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint='/v1/responses', completion_window=self.completion_window)
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        '''Returns the parsed output (and error) lines of a finished batch.'''
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(json.loads(line) for line in self.client.files.content(file_id).text.splitlines() if line.strip())
+        return lines
+
+
+class LocalBatchClient:
+    '''
+    Stand-in for OpenAIBatchClient that completes batches immediately. responder maps a request body to a Responses API
+    response body; by default every comparison comes back with no findings.
+    '''
+    def __init__(self, responder=None):
+        self.responder = responder or (lambda body: {'output': [{'type': 'message', 'content': [{'type': 'output_text', 'text': 'No clinically significant differences.'}]}]})
+        self.batches = {}
+
+    def submit(self, batch_path):
+        with open(batch_path, 'r') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        batch_id = f'local_batch_{len(self.batches)}'
+        results = []
+        for request in requests:
+            try:
+                results.append({'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': self.responder(request['body'])}, 'error': None})
+            except Exception as e:
+                results.append({'custom_id': request['custom_id'], 'response': None, 'error': {'message': str(e)}})
+        self.batches[batch_id] = results
+        return batch_id
+
+    def status(self, batch_id):
+        return 'completed'
+
+    def results(self, batch_id):
+        return self.batches[batch_id]
+
+
+def write_batch_files(evaluator, gen_paths, batch_dir=BATCH_DIR, max_requests=MAX_BATCH_REQUESTS):
+    '''
+    Writes one JSONL request file per max_requests comparisons and a matching .map.json recording which gen_note.txt and
+    standard each custom_id belongs to, and the fingerprint of the pair. gen_paths is {gen_path: fingerprint} or a list.
+    Returns the request file paths.
+    '''
+    fingerprints = gen_paths if isinstance(gen_paths, dict) else {}
+    gen_paths = list(gen_paths)
+    os.makedirs(batch_dir, exist_ok=True)
+    prefix = os.path.join(batch_dir, str(time.time()))
+    batch_paths = []
+    for start in range(0, len(gen_paths), max_requests):
+        batch_path = f'{prefix}_{start // max_requests}.jsonl'
+        mapping = {}
+        with open(batch_path, 'w') as f:
+            for i, gen_path in enumerate(gen_paths[start:start + max_requests]):
+                standard_path, standard_note, gen_note = evaluator.load_notes(gen_path)
+                custom_id = f'request-{start + i}'
+                mapping[custom_id] = {'gen_path': gen_path, 'standard_path': standard_path, 'fingerprint': fingerprints.get(gen_path)}
+                f.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/responses', 'body': evaluator.build_request(standard_note, gen_note)}) + '\n')
+        with open(batch_path.replace('.jsonl', '.map.json'), 'w') as f:
+            json.dump(mapping, f)
+        batch_paths.append(batch_path)
+    return batch_paths
+
+def submit(evaluator, gen_paths, client, batch_dir=BATCH_DIR, resume=False, incremental=False):
+    '''
+    Builds and submits the batch files for gen_paths, with incremental=True only those whose ai_eval.json fingerprint is
+    missing or stale. Returns the submitted batch ids, also recorded in {batch_path}.id.
+    '''
+    pending = evaluator.pending(gen_paths, 'llm', incremental)
+    if resume:
+        pending = {path: fingerprint for path, fingerprint in pending.items() if not evaluator.has_llm_eval(path)}
+    batch_ids = []
+    for batch_path in write_batch_files(evaluator, pending, batch_dir):
+        batch_id = client.submit(batch_path)
+        with open(batch_path.replace('.jsonl', '.id'), 'w') as f:
+            f.write(batch_id)
+        batch_ids.append((batch_id, batch_path))
+    return batch_ids
+
+def wait(client, batch_id, poll_interval=60, timeout=None):
+    start = time.time()
+    status = client.status(batch_id)
+    while status not in FINISHED_STATUSES:
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(f'Batch {batch_id} still {status} after {timeout}s')
+        time.sleep(poll_interval)
+        status = client.status(batch_id)
+    return status
+
+def collect(evaluator, client, batch_id, batch_path, overwrite=False):
+    '''Writes ai_eval.json for every successful result of a finished batch. Returns {gen_path: error} for requests that failed.'''
+    with open(batch_path.replace('.jsonl', '.map.json'), 'r') as f:
+        mapping = json.load(f)
+    failures = {}
+    results = client.results(batch_id)
+    for line in tqdm(results):
+        target = mapping[line['custom_id']]
+        response = line.get('response')
+        if line.get('error') or not response or response.get('status_code') != 200:
+            failures[target['gen_path']] = line.get('error') or response
+            continue
+        model_eval = evaluator.parse_output(response['body']['output'])
+        evaluator.write_llm(target['gen_path'], target['standard_path'], model_eval, overwrite=overwrite, fingerprint=target.get('fingerprint'))
+    missing = set(mapping) - {line['custom_id'] for line in results}
+    for custom_id in missing:
+        failures[mapping[custom_id]['gen_path']] = 'no result returned'
+    return failures
+
+def run(evaluator, gen_paths, client, batch_dir=BATCH_DIR, overwrite=False, resume=False, poll_interval=60, incremental=False):
+    '''Submits, waits for and collects every batch needed for gen_paths. Returns {gen_path: error} for failed comparisons.'''
+    failures = {}
+    for batch_id, batch_path in submit(evaluator, gen_paths, client, batch_dir, resume=resume, incremental=incremental):
+        status = wait(client, batch_id, poll_interval)
+        if status != 'completed':
+            print(f'Batch {batch_id} finished with status {status}')
+        failures.update(collect(evaluator, client, batch_id, batch_path, overwrite=overwrite))
+    return failures
+
+
+if __name__ == '__main__':
+    from evaluate import Evaluator, MODEL, SYSTEM_PROMPT, TOOLS, CLEAN_NOTES
+    from utils import search_file_paths
+
+    parser = argparse.ArgumentParser(description='Run the LLM judge offline through the OpenAI Batch API.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    submit_parser = subparsers.add_parser('submit', help='write and submit batch files for the selected gen_note.txt files')
+    submit_parser.add_argument('--paths', nargs='+', default=None)
+    submit_parser.add_argument('--idxs', nargs='+', default=['all'])
+    submit_parser.add_argument('--models', nargs='+', default=['all'])
+    submit_parser.add_argument('--prompts', nargs='+', default=['all'])
+    submit_parser.add_argument('--resume', action='store_true', help='skip notes that already have a matching ai_eval.json report')
+    submit_parser.add_argument('--incremental', action='store_true', help='skip notes whose ai_eval.json fingerprint is current')
+    collect_parser = subparsers.add_parser('collect', help='wait for a submitted batch and write its ai_eval.json reports')
+    collect_parser.add_argument('batch_path', help='the .jsonl batch file written by submit')
+    collect_parser.add_argument('--overwrite', action='store_true')
+    collect_parser.add_argument('--poll-interval', type=float, default=60)
+    args = parser.parse_args()
+
+    evaluator = Evaluator(model=MODEL, system_prompt=SYSTEM_PROMPT, tools=TOOLS, clean_notes=CLEAN_NOTES)
+    client = OpenAIBatchClient(evaluator.client)
+    if args.command == 'submit':
+        search_args = {k: 'all' if v == ['all'] else v for k, v in {'idxs': args.idxs, 'models': args.models, 'prompts': args.prompts}.items()}
+        gen_paths = args.paths or search_file_paths(filename='gen_note.txt', **search_args)
+        for batch_id, batch_path in submit(evaluator, gen_paths, client, resume=args.resume, incremental=args.incremental):
+            print(batch_id, batch_path)
+    else:
+        with open(args.batch_path.replace('.jsonl', '.id'), 'r') as f:
+            batch_id = f.read().strip()
+        print(f'Batch {batch_id} {wait(client, batch_id, args.poll_interval)}')
+        failures = collect(evaluator, client, batch_id, args.batch_path, overwrite=args.overwrite)
+        print(f'{len(failures)} failed comparisons')
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+
+'''
+End-to-end throughput benchmark that needs no model access. A local mock server stands in for the Ozwell completion
+endpoint, the Ollama generate API and the OpenAI Responses API, each with its own latency and error rate. generate.py and
+Evaluator.eval are then run over a synthetic corpus in a scratch workspace, and each phase reports notes/sec, p50/p95
+latency per note, peak RSS and file-system operation counts. The startup:<command> phases launch each python -m cli command
+in a fresh interpreter (notes/sec is launches/sec there), so slower startup shows up against a baseline too.
+
+    python bench.py                                   # 200 synthetic notes
+    python bench.py --notes 1000 --error-rate 0.05 --output bench.json
+    python bench.py --baseline bench.json             # exits 1 if a phase is more than --tolerance slower
+'''
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_NOTES = 200 # synthetic notes generated and evaluated per backend
+BENCH_SEED = 0
+MOCK_LATENCY = {'ozwell': (0.05, 0.02), 'ollama': (0.05, 0.02), 'openai': (0.1, 0.03)} # (mean, standard deviation) of the mock response time in seconds
+MOCK_ERROR_RATE = 0.02 # share of mock requests answered with a retryable 503
+NOTE_WORDS = 400 # words in each synthetic note
+FANOUT_MODELS = 3 # mock Ollama models every transcript is streamed to in the fan-out phase
+STARTUP_REPEATS = 5 # launches of each python -m cli command in the startup phases
+VOCABULARY = [f'term{i}' for i in range(2000)]
+FS_EVENTS = ['open', 'os.listdir', 'os.scandir', 'os.mkdir', 'os.rename', 'os.remove', 'os.symlink', 'os.rmdir']
+
+
+class FsCounter:
+    '''Counts file-system operations through an audit hook. Audit hooks cannot be removed, so counting is switched on and off instead.'''
+    def __init__(self):
+        self.counts = Counter()
+        self.enabled = False
+        self.lock = threading.Lock()
+        sys.addaudithook(self.hook)
+
+    def hook(self, event, args):
+        if self.enabled and event in FS_EVENTS:
+            with self.lock:
+                self.counts[event] += 1
+
+    def start(self):
+        self.counts = Counter()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        return dict(self.counts)
+
+
+def synthetic_text(rng, words=NOTE_WORDS):
+    sentences = []
+    while words > 0:
+        n = min(words, rng.randint(8, 20))
+        sentences.append(' '.join(rng.choice(VOCABULARY) for _ in range(n)))
+        words -= n
+    return '. '.join(sentences) + '.'
+
+def synthetic_corpus(n, seed=BENCH_SEED):
+    rng = random.Random(seed)
+    return pd.DataFrame([{'idx': i, 'conversation': synthetic_text(rng), 'full_note': synthetic_text(rng)} for i in range(1, n + 1)]).set_index('idx')
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        data = b''.join(json.dumps(line).encode('utf-8') + b'\n' for line in body) if isinstance(body, list) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-ndjson' if isinstance(body, list) else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        backend = {'/api/v1/completion': 'ozwell', '/api/generate': 'ollama', '/v1/responses': 'openai'}.get(self.path)
+        if backend is None:
+            return self.reply(404, {'error': f'unknown path {self.path}'})
+        mean, sd = server.latency[backend]
+        time.sleep(max(0.0, server.rng.gauss(mean, sd)))
+        server.requests[backend] += 1
+        if server.rng.random() < server.error_rate:
+            server.errors[backend] += 1
+            return self.reply(503, {'error': 'mock overload'}, {'Retry-After': '0', 'retry-after-ms': '1'})
+        note = synthetic_text(random.Random(json.dumps(body, sort_keys=True)))
+        if backend == 'ozwell':
+            self.reply(200, {'choices': [{'message': {'role': 'assistant', 'content': note}}], 'usage': {'prompt_tokens': len(json.dumps(body)) // 4, 'completion_tokens': len(note) // 4}})
+        elif backend == 'ollama' and body.get('stream'):
+            words = note.split(' ')
+            chunks = [{'model': body.get('model'), 'created_at': '1970-01-01T00:00:00Z', 'response': ' '.join(words[i:i + 20]) + ' ', 'done': False} for i in range(0, len(words), 20)]
+            chunks.append({'model': body.get('model'), 'created_at': '1970-01-01T00:00:00Z', 'response': '', 'done': True, 'prompt_eval_count': len(json.dumps(body)) // 4, 'eval_count': len(note) // 4})
+            self.reply(200, chunks)
+        elif backend == 'ollama':
+            self.reply(200, {'model': body.get('model'), 'created_at': '1970-01-01T00:00:00Z', 'response': note, 'done': True, 'prompt_eval_count': len(json.dumps(body)) // 4, 'eval_count': len(note) // 4})
+        else:
+            prefix_tokens = len(json.dumps([body.get('tools'), body.get('input', [{}])[0]])) // 4
+            cached_tokens = prefix_tokens if server.prompt_cache_keys[body.get('prompt_cache_key')] else 0
+            server.prompt_cache_keys[body.get('prompt_cache_key')] += 1
+            finding = {'clinical_concept': random.Random(note).choice(VOCABULARY), 'category': 'other', 'severity': 'low', 'confidence': 0.5, 'rationale': 'mock', 'evidence': {'section': 'Plan', 'snippet_B': 'mock'}}
+            self.reply(200, {'id': 'resp_mock', 'object': 'response', 'created_at': 0, 'model': body.get('model'), 'status': 'completed', 'output': [
+                {'type': 'function_call', 'id': 'fc_mock', 'call_id': 'call_mock', 'name': 'report_added_doc', 'arguments': json.dumps(finding), 'status': 'completed'}
+            ], 'usage': {'input_tokens': len(json.dumps(body)) // 4, 'output_tokens': 50, 'total_tokens': len(json.dumps(body)) // 4 + 50,
+                         'input_tokens_details': {'cached_tokens': cached_tokens}, 'output_tokens_details': {'reasoning_tokens': 0}}})
+
+
+class MockServer:
+    '''The mock model server, running on a background thread at self.url.'''
+    def __init__(self, latency=MOCK_LATENCY, error_rate=MOCK_ERROR_RATE, seed=BENCH_SEED):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.error_rate = error_rate
+        self.httpd.rng = random.Random(seed)
+        self.httpd.requests = Counter()
+        self.httpd.errors = Counter()
+        self.httpd.prompt_cache_keys = Counter()
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        return {'requests': dict(self.httpd.requests), 'errors': dict(self.httpd.errors)}
+
+
+def run_phase(name, items, run, fs_counter):
+    '''Runs run(item) for every item, timing each one. Returns the phase report.'''
+    latencies, failures = [], 0
+    fs_counter.start()
+    start = time.perf_counter()
+    for item in items:
+        item_start = time.perf_counter()
+        try:
+            run(item)
+        except Exception as e:
+            failures += 1
+            print(f'{name}: {e}')
+        latencies.append(time.perf_counter() - item_start)
+    elapsed = time.perf_counter() - start
+    fs_ops = fs_counter.stop()
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        'phase': name,
+        'notes': len(items),
+        'failures': failures,
+        'seconds': elapsed,
+        'notes_per_second': len(items) / elapsed if elapsed else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p95_ms': float(np.percentile(latencies, 95) * 1000),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'fs_ops': fs_ops
+    }
+
+def run_generate_phase(name, df, generator, workspace, max_in_flight, fs_counter):
+    '''Times generate.generate_concurrent (or generate with max_in_flight=None) over df. Per-note latency is the time spent in send.'''
+    import generate
+    latencies = []
+    send = generator.send
+
+    def timed_send(data, use_cache=True):
+        start = time.perf_counter()
+        try:
+            return send(data, use_cache=use_cache)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    generator.send = timed_send
+    report = run_phase(name, [df], lambda chunk: generate.generate_concurrent(chunk, generator, root=workspace, max_in_flight=max_in_flight) if max_in_flight else generate.generate(chunk, generator, root=workspace), fs_counter)
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    report.update({'notes': len(df), 'notes_per_second': len(df) / report['seconds'], 'p50_ms': float(np.percentile(latencies, 50) * 1000), 'p95_ms': float(np.percentile(latencies, 95) * 1000)})
+    return report
+
+def benchmark(notes=BENCH_NOTES, latency=MOCK_LATENCY, error_rate=MOCK_ERROR_RATE, max_in_flight=8, seed=BENCH_SEED, keep=False, startup_repeats=STARTUP_REPEATS):
+    '''Builds a scratch workspace, runs every phase against the mock server and returns the phase reports.'''
+    import requester
+    import generate
+    from set_standards import set_standard
+    from evaluate import Evaluator, MODEL, SYSTEM_PROMPT, TOOLS
+    from openai import OpenAI
+    from utils import search_file_paths
+    from telemetry import Telemetry
+    import cli
+
+    fs_counter = FsCounter()
+    workspace = tempfile.mkdtemp(prefix='bench_')
+    cwd = os.getcwd()
+    reports = []
+    run_telemetry = Telemetry(path=None)
+    try:
+        os.chdir(workspace)
+        os.makedirs('results')
+        df = synthetic_corpus(notes, seed)
+        generate.init_dirs(df[['conversation', 'full_note']], root=workspace)
+        for idx in df.index:
+            set_standard(idx, os.path.join('results', str(idx), 'full_note.txt'))
+        with MockServer(latency, error_rate, seed) as server:
+            requester_args = {'root_dir': REPO_DIR, 'backoff': 0.01, 'max_backoff': 0.1, 'max_retries': 10, 'telemetry': run_telemetry}
+            generators = [
+                ('generate:ozwell', requester.OzwellRequester('g1', url=f'{server.url}/api/v1/completion', **requester_args)),
+                ('generate:ollama', requester.OllamaRequester('bench-model', 'g1', host=server.url, **requester_args))
+            ]
+            for name, generator in generators:
+                reports.append(run_generate_phase(name, df, generator, workspace, max_in_flight, fs_counter))
+            fanout = [requester.AsyncOllamaRequester(f'bench-model-{i}', 'g1', host=server.url, **requester_args) for i in range(FANOUT_MODELS)]
+            report = run_phase('generate:ollama-fanout', [df], lambda chunk: generate.generate_fanout(chunk, fanout, root=workspace, slots=max_in_flight or 1), fs_counter)
+            report.update({'notes': len(df) * len(fanout), 'notes_per_second': len(df) * len(fanout) / report['seconds']})
+            report['p50_ms'], report['p95_ms'] = None, None # per-note stream latency is in the telemetry summary (p50_seconds, p50_first_token_seconds)
+            reports.append(report)
+            evaluator = Evaluator(model=MODEL, system_prompt=SYSTEM_PROMPT, tools=TOOLS, telemetry=run_telemetry)
+            evaluator._client = OpenAI(base_url=f'{server.url}/v1', api_key='bench', max_retries=10)
+            gen_paths = search_file_paths(filename='gen_note.txt', use_index=False)
+            reports.append(run_phase('evaluate', gen_paths, evaluator.eval, fs_counter))
+            server_stats = server.stats()
+        for command in cli.COMMANDS if startup_repeats else []:
+            reports.append(run_phase(f'startup:{command}', range(startup_repeats), lambda _: cli.launch(command, cwd=REPO_DIR), fs_counter))
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return reports, server_stats, run_telemetry.summary()
+
+def compare(reports, baseline, tolerance):
+    '''Returns the phases whose notes/sec fell more than tolerance (a fraction) below baseline.'''
+    baseline = {report['phase']: report for report in baseline}
+    return [(report['phase'], baseline[report['phase']]['notes_per_second'], report['notes_per_second'])
+            for report in reports if report['phase'] in baseline and report['notes_per_second'] < baseline[report['phase']]['notes_per_second'] * (1 - tolerance)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark generation and evaluation throughput against a local mock model server.')
+    parser.add_argument('--notes', type=int, default=BENCH_NOTES)
+    parser.add_argument('--latency', type=float, default=None, help='mean mock latency in seconds for every backend (default: MOCK_LATENCY)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the mock latency when --latency is given')
+    parser.add_argument('--error-rate', type=float, default=MOCK_ERROR_RATE)
+    parser.add_argument('--max-in-flight', type=int, default=8, help='concurrent generation requests, 0 for the sequential generate()')
+    parser.add_argument('--seed', type=int, default=BENCH_SEED)
+    parser.add_argument('--output', default=None, help='write the phase reports to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON file from an earlier --output run to compare notes/sec against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed notes/sec drop against --baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch workspace')
+    parser.add_argument('--startup-repeats', type=int, default=STARTUP_REPEATS, help='launches per command in the startup phases, 0 to skip them')
+    args = parser.parse_args()
+
+    latency = MOCK_LATENCY if args.latency is None else {backend: (args.latency, args.jitter) for backend in MOCK_LATENCY}
+    reports, server_stats, calls = benchmark(args.notes, latency, args.error_rate, args.max_in_flight or None, args.seed, args.keep, args.startup_repeats)
+    table = pd.DataFrame([{k: v for k, v in report.items() if k != 'fs_ops'} for report in reports]).set_index('phase')
+    print(table.round(2).to_string())
+    for report in reports:
+        print(f"{report['phase']} fs ops: {report['fs_ops']}")
+    print(f'mock server: {server_stats}')
+    print(calls.round(3).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(reports, json.load(f), args.tolerance)
+        for phase, before, after in regressions:
+            print(f'REGRESSION {phase}: {before:.1f} -> {after:.1f} notes/sec')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+'''
+On-disk cache of model completions keyed by a hash of everything that determines the output
+(backend, model, system prompt, input). Entries older than ttl seconds are dropped, and once the cache
+grows past max_bytes the least recently used entries are evicted.
+'''
+CACHE_PATH = os.path.join('cache', 'completions.db')
+
+
+def make_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=1 << 30, ttl=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)')
+
+    def get(self, key):
+        '''Returns the cached value for key, or None on a miss.'''
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, created FROM completions WHERE key = ?', (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self.conn.execute('DELETE FROM completions WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE completions SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO completions (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)', (key, value, len(value), now, now))
+            self.evict()
+
+    def evict(self):
+        if self.ttl is not None:
+            self.conn.execute('DELETE FROM completions WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_bytes is not None:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+            if total > self.max_bytes:
+                self.conn.execute('''
+                    DELETE FROM completions WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS running_size FROM completions
+                        ) WHERE running_size > ?
+                    )''', (self.max_bytes,))
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM completions')
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        self.conn.close()
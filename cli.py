@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import subprocess
+
+'''
+Single entry point for the pipeline. A subcommand's module is imported only when that subcommand runs, so the model backends
+(openai, ollama, requests) and the plotting libraries (seaborn, matplotlib) load only for the commands that need them. Run it
+from the repository root:
+
+    python -m cli generate --model ozwell --prompt g2 --idxs 224 431
+    python -m cli set-standards
+    python -m cli evaluate --stages rouge --idxs all
+    python -m cli analyze
+    python -m cli plot --models ozwell --prompts g1 g2
+    python -m cli startup              # time launching every command, as a scheduler would
+    python -m cli evaluate --help      # the arguments of a command
+
+Every run appends its startup cost (module import time, CPU time spent before the command started) to STARTUP_LOG.
+python -X importtime -m cli <command> --help shows which imports it went to.
+'''
+COMMANDS = { # subcommand: module whose main(argv, prog) runs it
+    'generate': 'generate',
+    'set-standards': 'set_standards',
+    'evaluate': 'evaluate',
+    'analyze': 'analyze_results',
+    'plot': 'plot',
+}
+STARTUP_LOG = os.path.join('telemetry', 'startup.jsonl') # JSONL file startup times are appended to, or None to record nothing
+STARTUP_REPEATS = 5 # launches per command timed by the startup subcommand
+
+
+def log_startup(record, path=STARTUP_LOG):
+    if not path:
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def run(command, argv, log_path=STARTUP_LOG):
+    '''Imports the command's module and runs its main(argv), recording how long the import took and how long the run did.'''
+    started = time.time()
+    start = time.perf_counter()
+    module = importlib.import_module(COMMANDS[command])
+    import_seconds = time.perf_counter() - start
+    record = {'kind': 'run', 'command': command, 'started': started, 'import_seconds': import_seconds, 'startup_cpu_seconds': time.process_time(), 'status': 'ok'}
+    try:
+        module.main(argv, prog=f'python -m cli {command}')
+    except SystemExit as e:
+        # argparse exits after --help (code 0) and on usage errors
+        record['status'] = 'error' if e.code else 'ok'
+        raise
+    except BaseException:
+        record['status'] = 'error'
+        raise
+    finally:
+        record['run_seconds'] = time.perf_counter() - start - import_seconds
+        log_startup(record, log_path)
+
+def launch(command, cwd=None):
+    '''Wall seconds for a fresh interpreter to start, import command and print its --help, i.e. the fixed cost of every job.'''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'cli', '--startup-log', '', command, '--help'], cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def measure_startup(commands, repeats=STARTUP_REPEATS, log_path=STARTUP_LOG):
+    '''Launches each command repeats times. Returns {command: [wall seconds]} and appends a summary per command to log_path.'''
+    results = {}
+    for command in commands:
+        seconds = sorted(launch(command) for _ in range(repeats))
+        results[command] = seconds
+        log_startup({'kind': 'launch', 'command': command, 'started': time.time(), 'repeats': repeats, 'p50_seconds': seconds[len(seconds) // 2], 'min_seconds': seconds[0], 'max_seconds': seconds[-1]}, log_path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m cli', description='Generate, evaluate and analyze clinical notes.')
+    parser.add_argument('--startup-log', default=STARTUP_LOG, help="JSONL file startup times are appended to ('' to record nothing)")
+    parser.add_argument('command', choices=[*COMMANDS, 'startup'], help='subcommand to run')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments of the subcommand (see python -m cli <command> --help)')
+    args = parser.parse_args(argv)
+    if args.command != 'startup':
+        return run(args.command, args.args, args.startup_log)
+
+    startup_parser = argparse.ArgumentParser(prog='python -m cli startup', description='Time launching each command in a fresh interpreter.')
+    startup_parser.add_argument('commands', nargs='*', help='commands to time (default: all)')
+    startup_parser.add_argument('--repeats', type=int, default=STARTUP_REPEATS)
+    startup_args = startup_parser.parse_args(args.args)
+    unknown = set(startup_args.commands) - set(COMMANDS)
+    if unknown:
+        startup_parser.error(f"unknown commands: {', '.join(sorted(unknown))}")
+    for command, seconds in measure_startup(startup_args.commands or list(COMMANDS), startup_args.repeats, args.startup_log).items():
+        print(f'{command:<15} p50 {seconds[len(seconds) // 2] * 1000:7.1f} ms   min {seconds[0] * 1000:7.1f} ms   max {seconds[-1] * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
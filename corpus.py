@@ -0,0 +1,140 @@
+import os
+import json
+import mmap
+import sqlite3
+import argparse
+import threading
+
+'''
+Packed store of the dataset's per-idx source fields (conversation, note, transcript, summary, ...). Every value is appended to
+one data file and its (offset, length) is kept in a SQLite index next to it, so a workspace holds two files instead of one
+per idx and field. Reads slice the memory-mapped data file. generate.init_dirs packs into it when given a corpus. The packed
+fields are archival: nothing in the pipeline reads them back (generation reads the dataset), so get them here or unpack them.
+
+    python corpus.py get 562 conversation        # print one field
+    python corpus.py unpack --idxs 562 1834      # write results/{idx}/{field}.txt (summary.json) files back out
+'''
+CORPUS_PATH = os.path.join('results', 'corpus.bin')
+
+
+def field_filename(field):
+    return f'{field}.json' if field == 'summary' else f'{field}.txt'
+
+def field_text(field, value):
+    '''The text a source field is stored as, the same in the corpus as in its results/{idx}/ file.'''
+    return json.dumps(value) if field == 'summary' else str(value)
+
+def get_index_path(path):
+    return f'{path}.idx.db'
+
+
+class PackedCorpus:
+    def __init__(self, path=CORPUS_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        self.map = None
+        self.conn = sqlite3.connect(get_index_path(path), isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS fields (
+                idx INTEGER, field TEXT, offset INTEGER NOT NULL, length INTEGER NOT NULL,
+                PRIMARY KEY (idx, field)
+            )''')
+
+    def add(self, items):
+        '''Appends [(idx, field, text)] in one write and one transaction, skipping fields the corpus already has. Returns the number added.'''
+        with self.lock:
+            idxs = sorted({int(idx) for idx, _, _ in items})
+            present = set()
+            for start in range(0, len(idxs), 500):
+                batch = idxs[start:start + 500]
+                present.update(self.conn.execute(f'SELECT idx, field FROM fields WHERE idx IN ({",".join("?" * len(batch))})', batch).fetchall())
+            rows, chunks = [], []
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            for idx, field, text in items:
+                if (int(idx), field) in present:
+                    continue
+                present.add((int(idx), field))
+                data = text.encode('utf-8')
+                rows.append((int(idx), field, offset, len(data)))
+                chunks.append(data)
+                offset += len(data)
+            if not rows:
+                return 0
+            # data first, so an interrupted add leaves unreferenced bytes rather than index rows pointing past the end
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT INTO fields VALUES (?, ?, ?, ?)', rows)
+            self.conn.execute('COMMIT')
+        return len(rows)
+
+    def view(self, end):
+        '''The data file memory-mapped up to at least end, remapped after it has grown (an empty file cannot be mapped).'''
+        if end == 0:
+            return b''
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def get(self, idx, field):
+        with self.lock:
+            row = self.conn.execute('SELECT offset, length FROM fields WHERE idx = ? AND field = ?', (int(idx), field)).fetchone()
+            if row is None:
+                raise KeyError(f'{field} of idx {idx} not found in {self.path}')
+            offset, length = row
+            return self.view(offset + length)[offset:offset + length].decode('utf-8')
+
+    def fields(self, idx):
+        '''{field: text} of every field stored for idx.'''
+        with self.lock:
+            names = [field for field, in self.conn.execute('SELECT field FROM fields WHERE idx = ? ORDER BY field', (int(idx),))]
+        return {field: self.get(idx, field) for field in names}
+
+    def idxs(self):
+        with self.lock:
+            return [idx for idx, in self.conn.execute('SELECT DISTINCT idx FROM fields ORDER BY idx')]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        self.conn.close()
+
+
+def unpack(corpus, idxs=None, root='./'):
+    '''Writes the packed fields of idxs (default: all) back out as results/{idx}/ files, leaving existing files alone.'''
+    written = 0
+    for idx in idxs or corpus.idxs():
+        idx_dir = os.path.join(root, 'results', str(idx))
+        os.makedirs(idx_dir, exist_ok=True)
+        present = set(os.listdir(idx_dir))
+        for field, text in corpus.fields(idx).items():
+            if field_filename(field) not in present:
+                with open(os.path.join(idx_dir, field_filename(field)), 'w') as f:
+                    f.write(text)
+                written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read or unpack the packed source corpus written by generate.py --packed-corpus.')
+    parser.add_argument('--path', default=CORPUS_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    get_parser = subparsers.add_parser('get', help='print one field of one idx')
+    get_parser.add_argument('idx', type=int)
+    get_parser.add_argument('field')
+    unpack_parser = subparsers.add_parser('unpack', help='write packed fields back out as results/{idx}/ files')
+    unpack_parser.add_argument('--idxs', nargs='+', type=int, default=None)
+    args = parser.parse_args()
+    corpus = PackedCorpus(args.path)
+    if args.command == 'get':
+        print(corpus.get(args.idx, args.field))
+    else:
+        print(f'{unpack(corpus, args.idxs)} files written')
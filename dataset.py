@@ -0,0 +1,76 @@
+import os
+import re
+import json
+import pandas as pd
+
+'''
+Streaming access to augmented_notes_30K.jsonl. A byte-offset index of every idx is built on first use and cached next to the
+file (as {path}.idx.json) so single records can be read with one seek instead of loading the whole corpus.
+'''
+DATASET_PATH = os.path.join('augmented-clinical-notes', 'augmented_notes_30K.jsonl')
+IDX_PATTERN = re.compile(rb'^\s*\{\s*"idx"\s*:\s*(\d+)')
+
+
+def get_index_path(path):
+    return f'{path}.idx.json'
+
+def record_idx(line):
+    match = IDX_PATTERN.match(line)
+    if match:
+        return int(match[1])
+    return int(json.loads(line)['idx'])
+
+def build_index(path=DATASET_PATH):
+    offsets = {}
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                offsets[record_idx(line)] = offset
+            offset += len(line)
+    stat = os.stat(path)
+    with open(get_index_path(path), 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'offsets': offsets}, f)
+    return offsets
+
+def load_index(path=DATASET_PATH):
+    '''Returns {idx: byte offset}, rebuilding the cached index if the dataset changed since it was built.'''
+    index_path = get_index_path(path)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        stat = os.stat(path)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return {int(k): v for k, v in index['offsets'].items()}
+    return build_index(path)
+
+def iter_records(path=DATASET_PATH, idxs=None):
+    '''Yields records as dicts. With idxs='all' or None the file is streamed in order, otherwise only the given idxs are read by seeking to them.'''
+    if idxs is None or idxs == 'all':
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    offsets = load_index(path)
+    missing = [idx for idx in idxs if idx not in offsets]
+    if missing:
+        raise KeyError(f'idxs {missing} not found in {path}')
+    with open(path, 'rb') as f:
+        for offset in sorted(offsets[idx] for idx in idxs):
+            f.seek(offset)
+            yield json.loads(f.readline())
+
+def iter_chunks(path=DATASET_PATH, idxs=None, chunksize=1000):
+    '''Yields DataFrames of at most chunksize records, indexed by idx, so the full corpus never has to be in memory at once.'''
+    chunk = []
+    for record in iter_records(path, idxs):
+        chunk.append(record)
+        if len(chunk) == chunksize:
+            yield pd.DataFrame.from_records(chunk).set_index('idx')
+            chunk = []
+    if chunk:
+        yield pd.DataFrame.from_records(chunk).set_index('idx')
+
+def read_records(path=DATASET_PATH, idxs=None):
+    return pd.concat(iter_chunks(path, idxs))
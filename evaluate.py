@@ -1,19 +1,51 @@
 import json
-from urllib import response
 from dotenv import load_dotenv
-from openai import OpenAI
 import os
 from tqdm import tqdm
-from rouge import Rouge
-from utils import get_standard_path, search_file_paths, read, get_metadata_df, write_reports, melt_rouge_scores
+from rouge_batch import BatchRouge, score_pairs
+import similarity
+import sections
+from utils import get_standard_path, search_file_paths, ROUGE_REPORT
 import re
-import seaborn as sns
-import pandas as pd
+from cache import CompletionCache, make_key
+from note_cache import NoteCache
+import fingerprints
+import telemetry
+from rate_limit import get_rate_limiter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import argparse
+import batch_eval
+import path_index
+import random
+import time
+import threading
+import contextlib
+from collections import Counter
 
 
 CLEAN_NOTES = False
 MODEL = "o4-mini"  # strong tool-calling + reasoning; adjust per your account
 OVERWRITE_REPORTS = True  # if True, overwrite existing evaluation reports
+CACHE_PATH = None  # completion cache (e.g. 'cache/completions.db') that replays the judgement of a note pair compared before, or None to always call the model (so repeated runs re-judge)
+STAGES = ['rouge', 'similarity', 'llm']  # evaluation stages to run: 'rouge' (local, process parallel), 'similarity' (local TF-IDF cosine), 'llm' (remote judge queue) or 'llm-batch' (judge through the OpenAI Batch API)
+ROUGE_PROCESSES = None  # worker processes for the rouge stage, None for one per core
+ROUGE_CHUNKSIZE = 64  # notes handed to a rouge worker at a time
+ROUGE_TYPE_FILES = False  # if True, also write the older per-type rouge-1/2/l.json reports next to each note's rouge.json
+LLM_MAX_IN_FLIGHT = 4  # judge requests in flight at once in the llm stage, across all notes and samples
+LLM_RATE_LIMIT = None  # max judge requests started per second, None for no limit
+LLM_MAX_RETRIES = 3  # retries per note before the llm stage records it as failed
+JUDGE_SAMPLES = 1  # judge samples per note pair; with more than one, findings are voted on across samples
+JUDGE_MIN_AGREEMENT = 0.5  # share of samples that must report a finding for it to be kept
+SECTION_PARALLEL = False  # if True, judge long note pairs section by section (meds, allergies, assessment/plan, ...) with concurrent calls, see sections.py
+SECTION_MIN_CHARS = 4000  # with SECTION_PARALLEL, only note pairs where either note is at least this long are split
+NOTE_CACHE_PATH = 'cache/notes.db'  # on-disk cache of cleaned standard note text shared by worker processes and later runs, or None for in-process only
+TELEMETRY_PATH = telemetry.TELEMETRY_PATH  # JSONL file every judge call is recorded to (latency, tokens, cost), or None to record nothing
+INCREMENTAL = True  # if True, only evaluate notes whose report is missing or was made from different inputs (see fingerprints.py)
+FINGERPRINT_PATH = fingerprints.FINGERPRINT_PATH  # index of report fingerprints and note hashes used by incremental runs, or None to check the reports themselves
+STAGE_REPORTS = {'rouge': [ROUGE_REPORT], 'similarity': ['similarity.json'], 'llm': ['ai_eval.json']}  # reports each stage writes; a note is only current if all exist, and the last one's fingerprints are checked
+STAGE_TABLES = {'rouge': 'rouge', 'llm': 'ai_eval'}  # results store table each stage writes to, checked instead of the reports with --no-files
+STORE_PATH = None  # results store (e.g. 'results/results.db') that reports are also appended to, or None for JSON reports only
+GEN_FILE_PATHS = ['results/562/ozwell/g2/1761757526.969353/gen_note.txt', 'results/1834/ozwell/g2/1761757526.9657931/gen_note.txt']  # or None to search results/
 
 with open('tools.json') as f:
     TOOLS = json.load(f)
@@ -22,22 +54,147 @@ with open('prompts/evaluation/system_prompt.txt') as f:
     SYSTEM_PROMPT = f.read()
     
 class Evaluator:
-    def __init__(self, model, system_prompt, tools, clean_notes=False):
+    def __init__(self, model, system_prompt, tools, clean_notes=False, cache=None, store=None, write_files=True, note_cache_path=None, telemetry=None, fingerprints=None, section_parallel=False, section_min_chars=SECTION_MIN_CHARS, rouge_type_files=False):
+        '''
+        store is an optional store.ResultsStore that reports are appended to; write_files=False skips the per-note JSON reports.
+        ROUGE scores go to one rouge.json per note; rouge_type_files also writes the older rouge-1/2/l.json files.
+        Note text and its ROUGE/TF-IDF representations are cached per file (see note_cache.py), on disk too if note_cache_path is given.
+        telemetry is an optional telemetry.Telemetry that records every judge call.
+        fingerprints is an optional fingerprints.FingerprintIndex that speeds up finding stale reports (see pending).
+        With section_parallel, note pairs where either note has at least section_min_chars characters are judged by section.
+        '''
+        self.section_parallel = section_parallel
+        self.section_min_chars = section_min_chars
         load_dotenv()
+        self.fingerprints = fingerprints
+        self.cache = cache
+        self.telemetry = telemetry
+        self.note_cache_path = note_cache_path
+        self.notes = NoteCache(path=note_cache_path)
+        self.store = store
+        self.write_files = write_files
+        self.rouge_type_files = rouge_type_files
         self.model = model
         self.clean_notes = clean_notes
-        self.rouge = Rouge()
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.rouge = BatchRouge()
+        self._similarity = None
+        self._client = None
         self.system_prompt = system_prompt
         self.tools = tools
         
+    @property
+    def client(self):
+        # created (and the openai package imported) on first use, so local-only runs and worker processes start without it
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    @property
+    def similarity(self):
+        if self._similarity is None:
+            self._similarity = similarity.SemanticScorer(similarity.get_model())
+        return self._similarity
+
     def clean_text(self, text):
         text = re.sub(r'(\\n)|(\n)|(-)|(\*\*)', ' ', text)
         return re.sub(r' +', ' ', text).strip()
 
-    def compare_documents(self, doc_a: str, doc_b: str, include_raw=False):
+    def compare_documents(self, doc_a: str, doc_b: str, include_raw=False, use_cache=True, sample=0, request=None, limiter=None, slots=None):
+        '''
+        Results are served from self.cache when the same documents were compared before, unless include_raw is set or use_cache=False.
+        Each sample number is cached separately, so sample k of a pair always replays the same judgement. limiter, if given,
+        is waited on before each call that actually reaches the model, and slots (a semaphore) is held for the call's duration. With section_parallel, long notes whose sections
+        align are judged section by section instead (see compare_sections); a prepared request is always sent as is.
+        '''
+        if request is None and not include_raw:
+            pairs = self.section_pairs(doc_a, doc_b)
+            if pairs:
+                return self.compare_sections(doc_a, doc_b, pairs, use_cache=use_cache, sample=sample, limiter=limiter, slots=slots)
+        if self.cache is None or include_raw or not use_cache:
+            return self.timed_compare(doc_a, doc_b, include_raw, request=request, limiter=limiter, slots=slots)
+        key = make_key('openai', self.model, self.system_prompt, self.tools, doc_a, doc_b, *([sample] if sample else []))
+        result = self.cache.get(key)
+        if result is None:
+            result = self.timed_compare(doc_a, doc_b, request=request, limiter=limiter, slots=slots)
+            self.cache.set(key, result)
+        else:
+            with telemetry.span(self.telemetry, 'openai', self.model, 'evaluation', 'compare') as record:
+                record['cache_hit'] = True
+        return result
+
+    def timed_compare(self, doc_a, doc_b, include_raw=False, request=None, limiter=None, slots=None):
+        with slots if slots is not None else contextlib.nullcontext():
+            if limiter is not None:
+                limiter.wait()
+            with telemetry.span(self.telemetry, 'openai', self.model, 'evaluation', 'compare'):
+                return self._compare_documents(doc_a, doc_b, include_raw, request=request)
+
+    def section_pairs(self, doc_a, doc_b):
+        '''The aligned sections (see sections.align) to judge doc_a and doc_b by, or None to judge them whole.'''
+        if not self.section_parallel or max(len(doc_a), len(doc_b)) < self.section_min_chars:
+            return None
+        return sections.align(doc_a, doc_b)
+
+    def compare_sections(self, doc_a, doc_b, pairs, use_cache=True, sample=0, limiter=None, slots=None):
+        '''
+        Judges each aligned section pair concurrently with the same system prompt, tools and cache as a whole-note call, maps
+        the evidence offsets back to doc_a/doc_b (see sections.locate) and merges the findings of all sections, keeping the
+        most confident report of each clinical concept. One long call becomes len(pairs) short ones; they take their slots
+        from the same semaphore as every other judge call, so splitting does not raise the number of calls in flight.
+        '''
+        queued_at = time.time()
+
+        def run(pair):
+            _, section_a, section_b = pair
+            telemetry.mark_queued(queued_at)
+            return self.compare_documents(section_a.text, section_b.text, use_cache=use_cache, sample=sample, request=self.build_request(section_a.text, section_b.text), limiter=limiter, slots=slots)
+
+        with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+            results = list(executor.map(run, pairs))
+        added, missing, texts = [], [], []
+        for (name, section_a, section_b), result in zip(pairs, results):
+            added.extend(sections.locate(finding, 'B', section_b, doc_b) for finding in result['added'])
+            missing.extend(sections.locate(finding, 'A', section_a, doc_a) for finding in result['missing'])
+            if result['text']:
+                texts.append(f'[{name}] {result["text"]}')
+        return {
+            'added': merge_findings(added),
+            'missing': merge_findings(missing),
+            'text': '\n'.join(texts) or None,
+            'sections': [name for name, _, _ in pairs]
+        }
+
+    def compare_documents_sampled(self, doc_a: str, doc_b: str, samples, min_agreement=0.5, limiter=None, slots=None):
+        '''
+        Runs samples judge calls on one prepared request concurrently and votes on their findings (see vote_findings).
+        Cached samples are replayed, so raising samples only calls the model for the new ones. Notes judged by section
+        have no single request; each sample splits them again.
+        '''
+        request = None if self.section_pairs(doc_a, doc_b) else self.build_request(doc_a, doc_b)
+        queued_at = time.time()
+
+        def run(sample):
+            telemetry.mark_queued(queued_at)
+            return self.compare_documents(doc_a, doc_b, sample=sample, request=request, limiter=limiter, slots=slots)
+
+        with ThreadPoolExecutor(max_workers=samples) as executor:
+            results = list(executor.map(run, range(samples)))
+        return {
+            'added': vote_findings([r['added'] for r in results], min_agreement),
+            'missing': vote_findings([r['missing'] for r in results], min_agreement),
+            'text': next((r['text'] for r in results if r['text']), None),
+            'samples': samples
+        }
+
+    def build_request(self, doc_a: str, doc_b: str):
+        '''
+        Body of the Responses API request comparing doc_b to doc_a. Shared by the synchronous and the batch (batch_eval.py) judge.
+        The tools, system prompt, instruction and standard note come first and are byte-identical across calls, so every
+        comparison against the same standard shares a cacheable prefix; prompt_cache_key routes those requests to the same cache.
+        '''
         input_list = [
-            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "system", "content": self.system_prompt},
             {
                 "role": "user",
                 "content": [
@@ -47,59 +204,292 @@ class Evaluator:
                 ]
             }
         ]
+        return {"model": self.model, "input": input_list, "tools": self.tools, "tool_choice": "auto", "prompt_cache_key": self.prompt_cache_key(doc_a)}
 
-        # Make the call. Tool calls (if any) will appear in response.output with type='tool_call'.
-        resp = self.client.responses.create(
-            model=self.model,
-            input=input_list,
-            tools=self.tools,
-            tool_choice="auto"
-        )
+    def prompt_cache_key(self, doc_a):
+        return 'judge-' + make_key(self.model, self.system_prompt, self.tools, doc_a)[:32]
+
+    def parse_output(self, output):
+        '''Collects the report_added_doc/report_missing_doc tool calls and any text from Responses API output items (SDK objects or plain dicts).'''
+        def field(obj, key):
+            return obj.get(key) if isinstance(obj, dict) else getattr(obj, key, None)
 
         # Handle tool calls
         added, missing = [], []
         # The Responses API can return a list of output items; iterate and execute tools accordingly.
-        for item in resp.output:
-            if item.type == "function_call":
-                args = json.loads(item.arguments)
-                if item.name == "report_added_doc":
+        for item in output:
+            if field(item, "type") == "function_call":
+                args = json.loads(field(item, "arguments"))
+                if field(item, "name") == "report_added_doc":
                     added.append(args)
-                elif item.name == "report_missing_doc":
+                elif field(item, "name") == "report_missing_doc":
                     missing.append(args)
 
         # If there were no tool calls, capture any text the model returned
-        text_output = "\n".join([i.content[0].text for i in resp.output if getattr(i, "type", None) == "message"])
+        text_output = "\n".join([field(field(i, "content")[0], "text") for i in output if field(i, "type") == "message"])
+        return {
+            "added": added,
+            "missing": missing,
+            "text": text_output.strip() or None
+        }
+
+    def _compare_documents(self, doc_a: str, doc_b: str, include_raw=False, request=None):
+        # Make the call. Tool calls (if any) will appear in response.output with type='tool_call'.
+        resp = self.client.responses.create(**(request or self.build_request(doc_a, doc_b)))
+        usage = getattr(resp, 'usage', None)
+        if usage is not None:
+            details = getattr(usage, 'input_tokens_details', None)
+            telemetry.annotate(prompt_tokens=usage.input_tokens, completion_tokens=usage.output_tokens, cached_tokens=getattr(details, 'cached_tokens', None))
+        result = self.parse_output(resp.output)
         if include_raw:
-            return {
-                "added": added,
-                "missing": missing,
-                "text": text_output.strip() or None,
-                "raw": resp  # keep for audit if needed
-            }
-        else:
-            return {
-                "added": added,
-                "missing": missing,
-                "text": text_output.strip() or None
-            }
+            result["raw"] = resp  # keep for audit if needed
+        return result
         
-    def eval(self, gen_path, overwrite=False):
+    def read_note(self, path, standard=False):
+        return self.notes.text(path, self.clean_text if self.clean_notes else None, persist=standard)
+
+    def load_notes(self, gen_path):
         idx = int(gen_path.split('/')[-5])
         standard_path = get_standard_path(idx)
-        standard_note = read(standard_path)
-        gen_note = read(gen_path)
+        return standard_path, self.read_note(standard_path, standard=True), self.read_note(gen_path)
+
+    def rouge_scores(self, standard_path, standard_note, gen_note):
+        ref = self.notes.artifact(standard_path, 'rouge', lambda: self.rouge.tokenize(standard_note), clean=self.clean_notes)
+        return self.rouge.score_documents(self.rouge.tokenize(gen_note), ref)
+
+    def similarity_vector(self, standard_path, standard_note):
+        return self.notes.artifact(standard_path, 'tfidf', lambda: self.similarity.model.encode([standard_note])[0], clean=self.clean_notes)
+
+    def fingerprint(self, gen_path, stage, standard_path=None, samples=1):
+        '''
+        Hash of everything the stage's report for gen_path is computed from: the contents of the generated and standard notes,
+        whether they are cleaned, and for the llm stage the judge model, system prompt, tools, number of samples and section
+        splitting (for the similarity stage, the idf weights). Repointing a standard or editing the prompt changes it; touching a file does not.
+        '''
+        file_hash = self.fingerprints.file_hash if self.fingerprints is not None else fingerprints.file_hash
+        standard_path = standard_path or get_standard_path(int(gen_path.split('/')[-5]))
+        parts = [stage, file_hash(gen_path), file_hash(standard_path), self.clean_notes]
+        if stage == 'similarity':
+            parts.append(self.similarity.model.version)  # the idf weights, fitted first if there are none
+        elif stage == 'llm':
+            parts.extend([self.model, self.system_prompt, self.tools, samples, *([self.section_min_chars] if self.section_parallel else [])])
+        return make_key(*parts)
+
+    def has_report(self, gen_path, stage):
+        '''True if the stage's reports for gen_path exist: its files, or with write_files off its rows in the results store.'''
+        if self.write_files:
+            return all(os.path.exists(os.path.join(os.path.dirname(gen_path), report)) for report in STAGE_REPORTS[stage])
+        return self.store is not None and stage in STAGE_TABLES and self.store.has_rows(STAGE_TABLES[stage], gen_path)
+
+    def is_current(self, gen_path, stage, fingerprint):
+        '''
+        True if the stage's report for gen_path exists and was made from the inputs fingerprint describes. A note whose report
+        was deleted is stale whatever the fingerprint index says, and its index entry is dropped.
+        '''
+        if not self.has_report(gen_path, stage):
+            if self.fingerprints is not None:
+                self.fingerprints.delete(gen_path, stage)
+            return False
+        if self.fingerprints is not None and self.fingerprints.get(gen_path, stage) == fingerprint:
+            return True
+        if not self.write_files:
+            return False
+        with open(os.path.join(os.path.dirname(gen_path), STAGE_REPORTS[stage][-1]), 'r') as file:
+            current = any(r.get('fingerprint') == fingerprint for r in json.load(file))
+        if current:
+            self.record_fingerprint(gen_path, stage, fingerprint)
+        return current
+
+    def record_fingerprint(self, gen_path, stage, fingerprint):
+        if self.fingerprints is not None and fingerprint is not None:
+            self.fingerprints.set(gen_path, stage, fingerprint)
+
+    def pending(self, gen_paths, stage, incremental=False, samples=1):
+        '''
+        {gen_path: fingerprint} of the gen_paths the stage should evaluate: all of them, or with incremental=True only those
+        whose report is missing or stale. A note that cannot be fingerprinted (e.g. a missing file) is kept with fingerprint
+        None, so the stage reports its failure as usual.
+        '''
+        result = {}
+        for gen_path in dict.fromkeys(gen_paths):
+            try:
+                fingerprint = self.fingerprint(gen_path, stage, samples=samples)
+            except OSError:
+                result[gen_path] = None
+                continue
+            if not (incremental and self.is_current(gen_path, stage, fingerprint)):
+                result[gen_path] = fingerprint
+        if incremental:
+            print(f'{stage} stage: {len(result)} of {len(dict.fromkeys(gen_paths))} notes missing or stale')
+        return result
+
+    def eval(self, gen_path, overwrite=False):
+        standard_path, standard_note, gen_note = self.load_notes(gen_path)
         metadata = {'standard_note_path': standard_path, 'cleaned': self.clean_notes}
-        if self.clean_notes:
-            standard_note = self.clean_text(standard_note)
-            gen_note = self.clean_text(gen_note)
-        rouge_scores = self.rouge.get_scores(gen_note, standard_note, avg=False)
-        for key, value in rouge_scores[0].items():
-            report_path = os.path.join(os.path.dirname(gen_path), f'{key}.json')
-            self.write(report_path, [{**metadata, **value}], overwrite=overwrite)
-        metadata.update({'model': self.model})
-        model_eval = self.compare_documents(standard_note, gen_note, include_raw=False)
-        self.write(os.path.join(os.path.dirname(gen_path), f'ai_eval.json'),  [{**metadata, **model_eval}], overwrite=overwrite)
+        self.write_rouge(gen_path, {**metadata, 'fingerprint': self.fingerprint(gen_path, 'rouge', standard_path)}, self.rouge_scores(standard_path, standard_note, gen_note), overwrite=overwrite)
+        self.write_similarity(gen_path, {**metadata, 'fingerprint': self.fingerprint(gen_path, 'similarity', standard_path)}, self.similarity.score_vectors([gen_note], [self.similarity_vector(standard_path, standard_note)])[0], overwrite=overwrite)
+        self.eval_llm_one(gen_path, overwrite=overwrite, notes=(standard_path, standard_note, gen_note), fingerprint=self.fingerprint(gen_path, 'llm', standard_path))
+
+    def eval_llm_one(self, gen_path, overwrite=False, notes=None, samples=1, min_agreement=0.5, limiter=None, fingerprint=None, slots=None):
+        standard_path, standard_note, gen_note = notes or self.load_notes(gen_path)
+        if samples > 1:
+            model_eval = self.compare_documents_sampled(standard_note, gen_note, samples, min_agreement, limiter=limiter, slots=slots)
+        else:
+            model_eval = self.compare_documents(standard_note, gen_note, include_raw=False, limiter=limiter, slots=slots)
+        self.write_llm(gen_path, standard_path, model_eval, overwrite=overwrite, fingerprint=fingerprint)
+
+    def write_llm(self, gen_path, standard_path, model_eval, overwrite=False, fingerprint=None):
+        metadata = {'standard_note_path': standard_path, 'cleaned': self.clean_notes, 'model': self.model, 'fingerprint': fingerprint}
+        if self.store is not None:
+            self.store.add_ai_eval(gen_path, metadata, model_eval, overwrite=overwrite)
+        if self.write_files:
+            self.write(os.path.join(os.path.dirname(gen_path), f'ai_eval.json'),  [{**metadata, **model_eval}], overwrite=overwrite)
+        self.record_fingerprint(gen_path, 'llm', fingerprint)
+
+    def has_llm_eval(self, gen_path, samples=1):
+        '''True if ai_eval.json already holds a report for the currently set standard with this judge model, cleaning and number of samples.'''
+        report_path = os.path.join(os.path.dirname(gen_path), 'ai_eval.json')
+        if not os.path.exists(report_path):
+            return False
+        with open(report_path, 'r') as file:
+            reports = json.load(file)
+        standard_path = get_standard_path(int(gen_path.split('/')[-5]))
+        return any(r.get('standard_note_path') == standard_path and r.get('model') == self.model and r.get('cleaned') == self.clean_notes and r.get('samples', 1) == samples for r in reports)
+
+    def eval_llm(self, gen_paths, overwrite=False, resume=False, max_in_flight=4, rate_limit=None, max_retries=3, backoff=2.0, samples=1, min_agreement=0.5, incremental=False):
+        '''
+        Runs the LLM judge over gen_paths through its own queue: up to max_in_flight judge requests at once across all notes
+        and samples, started no faster than rate_limit per second, each note retried with jittered exponential backoff. With
+        samples > 1 every note is judged samples times concurrently and the findings are voted on. With resume=True, notes that already have a
+        matching ai_eval.json report are skipped; with incremental=True, notes whose report fingerprint is current are.
+        A note that still fails is recorded and does not stop the others. Returns {gen_path: exception} for the failed notes.
+        '''
+        pending = self.pending(gen_paths, 'llm', incremental, samples=samples)
+        gen_paths = list(pending)
+        if resume:
+            gen_paths = [path for path in gen_paths if not self.has_llm_eval(path, samples=samples)]
+        limiter = get_rate_limiter('openai', rate_limit)
+        # the notes' sample threads all share these, so no more than max_in_flight calls reach the model at once
+        slots = threading.BoundedSemaphore(max_in_flight)
+
+        def run(gen_path, queued_at):
+            for attempt in range(max_retries + 1):
+                telemetry.mark_queued(queued_at if attempt == 0 else None)
+                try:
+                    return self.eval_llm_one(gen_path, overwrite=overwrite, samples=samples, min_agreement=min_agreement, limiter=limiter, fingerprint=pending[gen_path], slots=slots)
+                except FileNotFoundError:
+                    raise
+                except Exception:
+                    if attempt == max_retries:
+                        raise
+                    time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+        failures = {}
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = {executor.submit(run, path, time.time()): path for path in gen_paths}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[futures[future]] = e
+                    print(f'LLM evaluation failed for {futures[future]}: {e}')
+        return failures
     
+    def eval_rouge(self, gen_paths, overwrite=False, processes=None):
+        '''
+        Scores many generated notes at once with rouge_batch.score_pairs, so each standard is read and tokenized once
+        for all of its generated notes, and writes the usual rouge.json reports. Returns one record per (note, rouge type).
+        '''
+        standard_paths = {idx: get_standard_path(idx) for idx in {int(path.split('/')[-5]) for path in gen_paths}}
+        standard_notes = {path: self.read_note(path, standard=True) for path in set(standard_paths.values())}
+        pairs, metadatas = [], []
+        for gen_path in gen_paths:
+            standard_path = standard_paths[int(gen_path.split('/')[-5])]
+            pairs.append((self.read_note(gen_path), standard_notes[standard_path]))
+            metadatas.append({'standard_note_path': standard_path, 'cleaned': self.clean_notes})
+        records = []
+        for gen_path, metadata, scores in zip(gen_paths, metadatas, score_pairs(pairs, processes=processes)):
+            self.write_rouge(gen_path, metadata, scores, overwrite=overwrite)
+            records.extend({'gen_path': gen_path, **metadata, 'rouge_type': key, **value} for key, value in scores.items())
+        return records
+
+    def eval_rouge_parallel(self, gen_paths, overwrite=False, processes=None, chunksize=64, incremental=False):
+        '''
+        Scores gen_paths across a process pool sized to the machine. Notes are sorted by idx and handed out in chunks so a
+        worker tokenizes each standard once per chunk; every note belongs to exactly one chunk, so workers never write the same
+        report file. Store rows are written by this process. Returns a summary with throughput and {gen_path: error} failures.
+        With incremental=True, notes whose report fingerprint is current are skipped.
+        '''
+        pending = self.pending(gen_paths, 'rouge', incremental)
+        gen_paths = sorted(pending, key=lambda path: int(path.split('/')[-5]))
+        chunks = [[(path, pending[path]) for path in gen_paths[i:i + chunksize]] for i in range(0, len(gen_paths), chunksize)]
+        processes = processes or os.cpu_count() or 1
+        start = time.time()
+        failures = {}
+        evaluated = 0
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_rouge_worker, initargs=(self.model, self.system_prompt, self.tools, self.clean_notes, self.write_files, self.note_cache_path, self.rouge_type_files)) as executor:
+            futures = [executor.submit(rouge_worker, chunk, overwrite) for chunk in chunks]
+            with tqdm(total=len(gen_paths)) as progress:
+                for future in as_completed(futures):
+                    results, chunk_failures = future.result()
+                    for gen_path, metadata, scores in results:
+                        if self.store is not None:
+                            self.store.add_rouge(gen_path, metadata, scores, overwrite=overwrite)
+                        self.record_fingerprint(gen_path, 'rouge', metadata['fingerprint'])
+                    evaluated += len(results)
+                    failures.update(chunk_failures)
+                    progress.update(len(results) + len(chunk_failures))
+        elapsed = time.time() - start
+        summary = {'evaluated': evaluated, 'failed': len(failures), 'seconds': elapsed, 'notes_per_second': evaluated / elapsed if elapsed else 0.0, 'processes': processes, 'failures': failures}
+        print(f"ROUGE stage: {evaluated} notes in {elapsed:.1f}s ({summary['notes_per_second']:.1f} notes/sec, {processes} processes), {len(failures)} failed")
+        for gen_path, error in failures.items():
+            print(f'  {gen_path}: {error}')
+        return summary
+
+    def eval_similarity(self, gen_paths, overwrite=False, batch_size=256, incremental=False):
+        '''
+        Scores gen_paths with the local TF-IDF cosine similarity (see similarity.py) a batch of notes at a time and writes a
+        similarity.json report next to each note. With incremental=True, notes whose report fingerprint is current are
+        skipped. A note that cannot be loaded (e.g. its idx has no standard) is recorded and does not stop the others.
+        Returns a summary with {gen_path: error} failures.
+        '''
+        pending = self.pending(gen_paths, 'similarity', incremental)
+        gen_paths = list(pending)
+        failures = {}
+        evaluated = 0
+        for start in tqdm(range(0, len(gen_paths), batch_size)):
+            batch = []
+            for gen_path in gen_paths[start:start + batch_size]:
+                try:
+                    standard_path, standard_note, gen_note = self.load_notes(gen_path)
+                    batch.append((gen_path, standard_path, gen_note, self.similarity_vector(standard_path, standard_note)))
+                except Exception as e:
+                    failures[gen_path] = repr(e)
+            scores = self.similarity.score_vectors([gen_note for _, _, gen_note, _ in batch], [vector for _, _, _, vector in batch])
+            for (gen_path, standard_path, _, _), score in zip(batch, scores):
+                self.write_similarity(gen_path, {'standard_note_path': standard_path, 'cleaned': self.clean_notes, 'fingerprint': pending[gen_path]}, score, overwrite=overwrite)
+            evaluated += len(batch)
+        print(f'Similarity stage: {evaluated} notes scored, {len(failures)} failed')
+        for gen_path, error in failures.items():
+            print(f'  {gen_path}: {error}')
+        return {'evaluated': evaluated, 'failed': len(failures), 'failures': failures}
+
+    def write_similarity(self, gen_path, metadata, scores, overwrite=False):
+        if self.write_files:
+            self.write(os.path.join(os.path.dirname(gen_path), 'similarity.json'), [{**metadata, 'method': 'tfidf', **scores}], overwrite=overwrite)
+        self.record_fingerprint(gen_path, 'similarity', metadata.get('fingerprint'))
+
+    def write_rouge(self, gen_path, metadata, scores, overwrite=False):
+        '''Writes one rouge.json record holding every rouge type's scores, plus the older rouge-*.json files with rouge_type_files.'''
+        if self.store is not None:
+            self.store.add_rouge(gen_path, metadata, scores, overwrite=overwrite)
+        if self.write_files:
+            self.write(os.path.join(os.path.dirname(gen_path), ROUGE_REPORT), [{**metadata, **scores}], overwrite=overwrite)
+            if self.rouge_type_files:
+                for key, value in scores.items():
+                    self.write(os.path.join(os.path.dirname(gen_path), f'{key}.json'), [{**metadata, **value}], overwrite=overwrite)
+        self.record_fingerprint(gen_path, 'rouge', metadata.get('fingerprint'))
+
     def write(self, path, data, overwrite=False):
         if os.path.exists(path) and not overwrite:
             with open(path, 'r') as file:
@@ -110,16 +500,156 @@ class Evaluator:
         else:
             with open(path, 'w') as file:
                 json.dump(data, file, indent=4)
+        path_index.record(path)
 
 
-if __name__=='__main__':
-    # gen_file_paths = search_file_paths(filename='gen_note.txt', idxs='all', models='ozwell', prompts='all')
-    gen_file_paths = ['results/562/ozwell/g2/1761757526.969353/gen_note.txt', 'results/1834/ozwell/g2/1761757526.9657931/gen_note.txt']
+def concept_key(finding):
+    return ' '.join(str(finding.get('clinical_concept', '')).lower().split())
+
+def merge_findings(findings):
+    '''One finding per clinical concept (see concept_key): the most confident report of each, in order of first appearance.'''
+    def confidence(finding):
+        return finding['confidence'] if isinstance(finding.get('confidence'), (int, float)) else 0
+
+    merged = {}
+    for finding in findings:
+        key = concept_key(finding)
+        if key not in merged or confidence(finding) > confidence(merged[key]):
+            merged[key] = finding
+    return list(merged.values())
+
+def vote_findings(samples, min_agreement=0.5):
+    '''
+    Merges the findings (report_added_doc or report_missing_doc arguments) of several judge samples. Findings are matched on
+    their normalized clinical_concept and counted once per sample; category and severity are majority votes. Each kept
+    finding gets agreement (share of samples reporting it), category_agreement and severity_agreement (share of those
+    samples agreeing with the vote), and confidence (the mean confidence the judge reported). Findings with agreement below
+    min_agreement are dropped. Returns the kept findings, most agreed first.
+    '''
+    reports = {}
+    for findings in samples:
+        seen = set()
+        for finding in findings:
+            key = concept_key(finding)
+            if key not in seen:
+                seen.add(key)
+                reports.setdefault(key, []).append(finding)
+    voted = []
+    for key, findings in reports.items():
+        agreement = len(findings) / len(samples)
+        if agreement < min_agreement:
+            continue
+        category, category_votes = Counter(f.get('category') for f in findings).most_common(1)[0]
+        severity, severity_votes = Counter(f.get('severity') for f in findings).most_common(1)[0]
+        representative = next((f for f in findings if f.get('category') == category and f.get('severity') == severity), findings[0])
+        confidences = [f['confidence'] for f in findings if isinstance(f.get('confidence'), (int, float))]
+        voted.append({
+            **representative,
+            'category': category,
+            'severity': severity,
+            'confidence': sum(confidences) / len(confidences) if confidences else None,
+            'agreement': agreement,
+            'category_agreement': category_votes / len(findings),
+            'severity_agreement': severity_votes / len(findings)
+        })
+    return sorted(voted, key=lambda f: -f['agreement'])
+
+
+_WORKER_EVALUATOR = None
+
+def init_rouge_worker(model, system_prompt, tools, clean_notes, write_files, note_cache_path=None, rouge_type_files=False):
+    global _WORKER_EVALUATOR
+    _WORKER_EVALUATOR = Evaluator(model=model, system_prompt=system_prompt, tools=tools, clean_notes=clean_notes, write_files=write_files, note_cache_path=note_cache_path, rouge_type_files=rouge_type_files)
+
+def rouge_worker(items, overwrite=False):
+    '''Scores and writes the reports for one chunk of (gen_path, fingerprint) in a worker process. Returns ([(gen_path, metadata, scores)], {gen_path: error}).'''
+    results, failures = [], {}
+    for gen_path, fingerprint in items:
+        try:
+            standard_path, standard_note, gen_note = _WORKER_EVALUATOR.load_notes(gen_path)
+            metadata = {'standard_note_path': standard_path, 'cleaned': _WORKER_EVALUATOR.clean_notes, 'fingerprint': fingerprint}
+            scores = _WORKER_EVALUATOR.rouge_scores(standard_path, standard_note, gen_note)
+            if _WORKER_EVALUATOR.write_files:
+                _WORKER_EVALUATOR.write_rouge(gen_path, metadata, scores, overwrite=overwrite)
+            results.append((gen_path, metadata, scores))
+        except Exception as e:
+            failures[gen_path] = repr(e)
+    return results, failures
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Evaluate generated notes against their standard notes.')
+    parser.add_argument('--stages', nargs='+', choices=['rouge', 'similarity', 'llm', 'llm-batch'], default=STAGES, help='evaluation stages to run')
+    parser.add_argument('--paths', nargs='+', default=None, help='gen_note.txt files to evaluate')
+    parser.add_argument('--model', default=MODEL, help='judge model for the llm stages')
+    parser.add_argument('--clean-notes', action=argparse.BooleanOptionalAction, default=CLEAN_NOTES, help='strip newlines, dashes and bold markers before comparing')
+    parser.add_argument('--idxs', nargs='+', default=None, help="search results/ for these idxs (or 'all')")
+    parser.add_argument('--models', nargs='+', default=None, help="search results/ for these models (or 'all')")
+    parser.add_argument('--prompts', nargs='+', default=None, help="search results/ for these prompts (or 'all')")
+    parser.add_argument('--overwrite', action=argparse.BooleanOptionalAction, default=OVERWRITE_REPORTS, help='overwrite existing reports instead of appending')
+    parser.add_argument('--resume', action='store_true', help='skip notes that already have a matching ai_eval.json report')
+    parser.add_argument('--incremental', action=argparse.BooleanOptionalAction, default=INCREMENTAL, help='only evaluate notes whose report is missing or stale')
+    parser.add_argument('--processes', type=int, default=ROUGE_PROCESSES, help='worker processes for the rouge stage')
+    parser.add_argument('--chunksize', type=int, default=ROUGE_CHUNKSIZE, help='notes handed to a rouge worker at a time')
+    parser.add_argument('--rouge-type-files', action=argparse.BooleanOptionalAction, default=ROUGE_TYPE_FILES, help='also write per-type rouge-1/2/l.json reports for tools that read them')
+    parser.add_argument('--max-in-flight', type=int, default=LLM_MAX_IN_FLIGHT, help='judge requests in flight at once for the llm stage, across all notes and samples')
+    parser.add_argument('--rate-limit', type=float, default=LLM_RATE_LIMIT, help='max judge requests started per second')
+    parser.add_argument('--max-retries', type=int, default=LLM_MAX_RETRIES, help='retries per note in the llm stage')
+    parser.add_argument('--samples', type=int, default=JUDGE_SAMPLES, help='judge samples per note in the llm stage, voted on when more than one')
+    parser.add_argument('--min-agreement', type=float, default=JUDGE_MIN_AGREEMENT, help='share of judge samples that must report a finding to keep it')
+    parser.add_argument('--sections', action=argparse.BooleanOptionalAction, default=SECTION_PARALLEL, help='judge long note pairs section by section with concurrent calls')
+    parser.add_argument('--section-min-chars', type=int, default=SECTION_MIN_CHARS, help='with --sections, split only pairs where a note is at least this long')
+    parser.add_argument('--cache', default=CACHE_PATH, help='completion cache to replay earlier judgements of the same note pair from')
+    parser.add_argument('--store', default=STORE_PATH, help='results store to append reports to')
+    parser.add_argument('--no-files', action='store_true', help='only write reports to --store, not to per-note JSON files')
+    parser.add_argument('--poll-interval', type=float, default=60, help='seconds between status checks in the llm-batch stage')
+    args = parser.parse_args(argv)
+
+    def search_arg(values):
+        return 'all' if values is None or values == ['all'] else values
+
+    store = None
+    if args.store:
+        from store import ResultsStore
+        store = ResultsStore(args.store)
+    if args.paths:
+        gen_file_paths = args.paths
+    elif GEN_FILE_PATHS is None or any(arg is not None for arg in (args.idxs, args.models, args.prompts)):
+        gen_file_paths = search_file_paths(filename='gen_note.txt', idxs=search_arg(args.idxs), models=search_arg(args.models), prompts=search_arg(args.prompts))
+    else:
+        gen_file_paths = GEN_FILE_PATHS
     eval = Evaluator(
-        model=MODEL,
+        model=args.model,
         system_prompt=SYSTEM_PROMPT,
         tools=TOOLS,
-        clean_notes=CLEAN_NOTES
+        clean_notes=args.clean_notes,
+        cache=CompletionCache(args.cache) if args.cache else None,
+        store=store,
+        write_files=not (args.no_files and args.store),
+        rouge_type_files=args.rouge_type_files,
+        note_cache_path=NOTE_CACHE_PATH,
+        telemetry=telemetry.Telemetry(TELEMETRY_PATH) if TELEMETRY_PATH else None,
+        fingerprints=fingerprints.FingerprintIndex(FINGERPRINT_PATH) if FINGERPRINT_PATH else None,
+        section_parallel=args.sections,
+        section_min_chars=args.section_min_chars
     )
-    for path in tqdm(gen_file_paths):
-        eval.eval(path, overwrite=OVERWRITE_REPORTS)
\ No newline at end of file
+    if 'rouge' in args.stages:
+        eval.eval_rouge_parallel(gen_file_paths, overwrite=args.overwrite, processes=args.processes, chunksize=args.chunksize, incremental=args.incremental)
+    if 'similarity' in args.stages:
+        eval.eval_similarity(gen_file_paths, overwrite=args.overwrite, incremental=args.incremental)
+    if 'llm' in args.stages:
+        failures = eval.eval_llm(gen_file_paths, overwrite=args.overwrite, resume=args.resume, max_in_flight=args.max_in_flight, rate_limit=args.rate_limit, max_retries=args.max_retries, samples=args.samples, min_agreement=args.min_agreement, incremental=args.incremental)
+        replayed = f', {eval.cache.hits} judgements replayed from {args.cache}' if eval.cache else ''
+        print(f'LLM stage: {len(gen_file_paths) - len(failures)} evaluated or skipped, {len(failures)} failed{replayed}')
+    if 'llm-batch' in args.stages:
+        failures = batch_eval.run(eval, gen_file_paths, batch_eval.OpenAIBatchClient(eval.client), overwrite=args.overwrite, resume=args.resume, poll_interval=args.poll_interval, incremental=args.incremental)
+        print(f'LLM batch stage: {len(failures)} failed')
+    if eval.cache:
+        print(eval.cache.stats())
+    print(f'Note cache: {eval.notes.stats()}')
+    if eval.telemetry and eval.telemetry.records:
+        print(eval.telemetry.write_report().to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
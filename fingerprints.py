@@ -0,0 +1,67 @@
+import os
+import hashlib
+import sqlite3
+import threading
+
+'''
+Fingerprints for incremental evaluation. A note's fingerprint for an evaluation stage hashes everything its report depends
+on (generated note, standard note, cleaning, judge model, system prompt, tools, ...), and every report records it. A re-run
+only evaluates the notes whose stored fingerprint is missing or different, e.g. because set_standard repointed a standard.
+File contents are hashed once per (path, mtime, size), so unchanged notes are only stat'ed.
+'''
+FINGERPRINT_PATH = os.path.join('cache', 'fingerprints.db') # a cache of file hashes, so kept with the other caches rather than in results/
+
+
+class FingerprintIndex:
+    def __init__(self, path=FINGERPRINT_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha256 TEXT
+            );
+            CREATE TABLE IF NOT EXISTS reports (
+                gen_path TEXT, stage TEXT, fingerprint TEXT,
+                PRIMARY KEY (gen_path, stage)
+            );
+        ''')
+
+    def file_hash(self, path):
+        '''sha256 of the file at path (symlinks resolved), re-read only if its mtime or size changed.'''
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute('SELECT mtime_ns, size, sha256 FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[:2] == (stat.st_mtime_ns, stat.st_size):
+            return row[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, stat.st_mtime_ns, stat.st_size, digest))
+        return digest
+
+    def get(self, gen_path, stage):
+        with self.lock:
+            row = self.conn.execute('SELECT fingerprint FROM reports WHERE gen_path = ? AND stage = ?', (os.path.normpath(gen_path), stage)).fetchone()
+        return row[0] if row else None
+
+    def set(self, gen_path, stage, fingerprint):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO reports VALUES (?, ?, ?)', (os.path.normpath(gen_path), stage, fingerprint))
+
+    def delete(self, gen_path, stage):
+        with self.lock:
+            self.conn.execute('DELETE FROM reports WHERE gen_path = ? AND stage = ?', (os.path.normpath(gen_path), stage))
+
+    def close(self):
+        self.conn.close()
+
+
+def file_hash(path):
+    '''FingerprintIndex.file_hash without an index: always reads the file.'''
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -1,9 +1,16 @@
 import os
 from tqdm import tqdm
 import time
-import requester
-import pandas as pd
-import json
+from rate_limit import get_rate_limiter
+from manifest import RunManifest
+import dataset
+from corpus import PackedCorpus, field_filename, field_text
+import path_index
+from cache import CompletionCache
+import telemetry
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 '''
 Run this script to generate clinical notes using a specified model and prompt.
@@ -12,42 +19,230 @@ GENERATE_MODEL_NAME = 'ozwell'
 GENERATE_PROMPT_NAME = 'g2'
 # IDXS = [224, 431, 562, 619, 958, 1380, 1716, 1834, 2021, 3026, 3058, 3093, 3293, 3931, 4129] # or 'all'
 IDXS = [155216]
-def init_dirs(df, root='./'):
-    for idx, row in tqdm(df.iterrows(), total=len(df), ncols=50):
-        if str(idx) not in os.listdir(os.path.join(root, 'results')):
-            os.makedirs(os.path.join(root, 'results', str(idx)))
-        for k,v in row.to_dict().items():
-            if k == 'summary':
-                if not os.path.exists(os.path.join(root, 'results', str(idx), f'{k}.json')):
-                    with open(os.path.join(root, 'results', str(idx), f'{k}.json'), 'w') as f:
-                        json.dump(v, f)
-            else:
-                if not os.path.exists(os.path.join(root, 'results', str(idx), f'{k}.txt')):
-                    with open(os.path.join(root, 'results', str(idx), f'{k}.txt'), 'w') as f:
-                        f.write(str(v))
-
-def generate(df, generator, root='./'):
+MAX_IN_FLIGHT = 8 # number of requests kept in flight at once, or None to generate one row at a time
+RATE_LIMITS = {'ozwell': 2.0, 'ollama': None} # max requests started per second for each backend, None for no limit
+REPLICATES = 1 # number of notes to generate per idx for this model/prompt
+USE_MANIFEST = False # if True, record planned/finished work in results/manifest.db and skip anything already done when re-run; off, every run generates fresh notes
+CHUNKSIZE = 1000 # number of dataset records loaded into memory at a time
+TELEMETRY_PATH = telemetry.TELEMETRY_PATH # JSONL file every model call is recorded to (latency, tokens, retries), or None to record nothing
+FANOUT_MODELS = None # list of Ollama models (e.g. ['llama3.1:8b', 'qwen2.5:7b']) to stream every transcript to at once instead of GENERATE_MODEL_NAME, or None
+OLLAMA_SLOTS = 2 # generations running at once across all FANOUT_MODELS, sized to the GPU/CPU the Ollama server has
+OLLAMA_KEEP_ALIVE = '30m' # how long Ollama keeps each model loaded between requests
+CACHE_PATH = None # path of a completion cache (e.g. 'cache/completions.db') to reuse identical earlier completions, or None to always call the model
+PACKED_CORPUS = None # path of a packed source corpus (e.g. 'results/corpus.bin', see corpus.py) to store source fields in instead of per-idx files, or None
+FILE_FIELDS = ['full_note'] # source fields still written as results/{idx}/ files with a packed corpus (standards symlink to full_note.txt)
+
+def init_dirs(df, root='./', corpus=None):
+    '''
+    Writes the source fields of df's rows to results/{idx}/{field}.txt (summary.json), leaving existing files alone.
+    results/ is listed once per call and only idx directories that already existed are listed again, so a chunk costs
+    O(rows) file-system calls. With corpus (a corpus.PackedCorpus), fields other than FILE_FIELDS are appended to it in one
+    batch instead of becoming files.
+    '''
+    results_dir = os.path.join(root, 'results')
+    os.makedirs(results_dir, exist_ok=True)
+    existing = {entry.name for entry in os.scandir(results_dir) if entry.is_dir()}
+    packed = []
+    for idx, row in tqdm(zip(df.index, df.to_dict('records')), total=len(df), ncols=50):
+        idx_dir = os.path.join(results_dir, str(idx))
+        if str(idx) in existing:
+            present = set(os.listdir(idx_dir))
+        else:
+            os.makedirs(idx_dir, exist_ok=True)
+            present = set()
+        for k, v in row.items():
+            if corpus is not None and k not in FILE_FIELDS:
+                packed.append((idx, k, field_text(k, v)))
+            elif field_filename(k) not in present:
+                with open(os.path.join(idx_dir, field_filename(k)), 'w') as f:
+                    f.write(field_text(k, v))
+    if packed:
+        corpus.add(packed)
+
+def plan_work(df, generator, root='./', manifest=None, replicates=1):
+    '''
+    Returns (idx, replicate, path, conversation) for each note to generate. Without a manifest every row gets `replicates` new timestamp directories.
+    With a manifest only the items that are not done are returned, reusing the directory of an item that was interrupted mid-run.
+    '''
+    planned = set()
+
+    def new_path(idx):
+        # replicates of an idx planned within one clock tick would share a timestamp, so step past any path already taken
+        timestamp = time.time()
+        while True:
+            path = os.path.join(root, 'results', str(idx), generator.model_name, generator.prompt_name, str(timestamp))
+            if path not in planned and not os.path.exists(path):
+                planned.add(path)
+                return path
+            timestamp += 1e-6
+
+    if manifest is None:
+        return [(idx, r, new_path(idx), row['conversation']) for idx, row in df.iterrows() for r in range(replicates)]
+    manifest.plan(df.index, generator.model_name, generator.prompt_name, replicates)
+    work = []
+    for idx, replicate, path in manifest.pending(generator.model_name, generator.prompt_name, df.index, replicates):
+        if path and os.path.exists(os.path.join(path, 'gen_note.txt')):
+            manifest.mark_done(idx, generator.model_name, generator.prompt_name, replicate)
+            continue
+        work.append((idx, replicate, path or new_path(idx), df.at[idx, 'conversation']))
+    return work
+
+def generate(df, generator, root='./', manifest=None, replicates=1):
     df = df.copy()
     if 'idx' in df.columns:
         df = df.set_index('idx')
-    for idx, row in tqdm(df.iterrows(), total=len(df), ncols=50):
-        timestamp = str(time.time())
-        path = os.path.join(root, 'results', str(idx), generator.model_name, generator.prompt_name, timestamp)
+    work = plan_work(df, generator, root, manifest, replicates)
+    for idx, replicate, path, conversation in tqdm(work, total=len(work), ncols=50):
         if not os.path.exists(path):
             os.makedirs(path)
-        gen_note = generator.send(row['conversation'])
+        if manifest:
+            manifest.mark_running(idx, generator.model_name, generator.prompt_name, replicate, path)
+        try:
+            gen_note = generator.send(conversation, use_cache=replicates == 1)
+        except Exception as e:
+            if manifest:
+                manifest.mark_failed(idx, generator.model_name, generator.prompt_name, replicate, e)
+            raise
         with open(os.path.join(path, "gen_note.txt"), 'w') as f:
             f.write(gen_note)
+        path_index.record(os.path.join(path, "gen_note.txt"))
+        if manifest:
+            manifest.mark_done(idx, generator.model_name, generator.prompt_name, replicate)
 
-if __name__ == '__main__':
-    if GENERATE_MODEL_NAME == 'ozwell':
-        req_gen = requester.OzwellRequester(GENERATE_PROMPT_NAME)
+def generate_concurrent(df, generator, root='./', max_in_flight=8, rate_limit=None, manifest=None, replicates=1):
+    '''
+    Same as generate, but keeps up to max_in_flight requests running at once and writes each gen_note.txt as soon as its request completes.
+    rate_limit caps the number of requests started per second and is shared by every generator of the same backend.
+    '''
+    df = df.copy()
+    if 'idx' in df.columns:
+        df = df.set_index('idx')
+    limiter = get_rate_limiter(generator.backend, rate_limit)
+
+    def send(conversation, queued_at):
+        telemetry.mark_queued(queued_at)
+        limiter.wait()
+        return generator.send(conversation, use_cache=replicates == 1)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {}
+        for idx, replicate, path, conversation in plan_work(df, generator, root, manifest, replicates):
+            if manifest:
+                manifest.mark_running(idx, generator.model_name, generator.prompt_name, replicate, path)
+            futures[executor.submit(send, conversation, time.time())] = (idx, replicate, path)
+        for future in tqdm(as_completed(futures), total=len(futures), ncols=50):
+            idx, replicate, path = futures[future]
+            try:
+                gen_note = future.result()
+            except Exception as e:
+                print(f'Generation failed for idx {idx}: {e}')
+                if manifest:
+                    manifest.mark_failed(idx, generator.model_name, generator.prompt_name, replicate, e)
+                continue
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "gen_note.txt"), 'w') as f:
+                f.write(gen_note)
+            path_index.record(os.path.join(path, "gen_note.txt"))
+            if manifest:
+                manifest.mark_done(idx, generator.model_name, generator.prompt_name, replicate)
+
+async def generate_fanout_async(df, generators, root='./', slots=2, manifest=None, replicates=1):
+    semaphore = asyncio.Semaphore(slots)
+    work = [(generator, item) for generator in generators for item in plan_work(df, generator, root, manifest, replicates)]
+    # ordered by transcript so the requests for one transcript go out to every model together
+    order = {idx: i for i, idx in enumerate(df.index)}
+    work.sort(key=lambda w: (order[w[1][0]], w[1][1]))
+    progress = tqdm(total=len(work), ncols=50)
+
+    async def run(generator, idx, replicate, path, conversation, queued_at):
+        async with semaphore:
+            telemetry.mark_queued(queued_at)
+            # the note streams into {timestamp}.part next to its directory, which is only created once the note is complete,
+            # so a failed stream leaves no empty run behind
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if manifest:
+                manifest.mark_running(idx, generator.model_name, generator.prompt_name, replicate, path)
+            try:
+                await generator.asend(conversation, os.path.join(path, 'gen_note.txt'), use_cache=replicates == 1, partial=f'{path}.part')
+            except Exception as e:
+                print(f'Generation failed for idx {idx} with {generator.model_name}: {e}')
+                if manifest:
+                    manifest.mark_failed(idx, generator.model_name, generator.prompt_name, replicate, e)
+                return
+            finally:
+                progress.update(1)
+            path_index.record(os.path.join(path, 'gen_note.txt'))
+            if manifest:
+                manifest.mark_done(idx, generator.model_name, generator.prompt_name, replicate)
+
+    queued_at = time.time()
+    await asyncio.gather(*(run(generator, *item, queued_at) for generator, item in work))
+    progress.close()
+
+def generate_fanout(df, generators, root='./', slots=2, manifest=None, replicates=1):
+    '''
+    Streams every transcript in df to each of generators (requester.AsyncOllamaRequester, one per model) concurrently, with at
+    most `slots` generations running at once. Each gen_note.txt is written as it streams to {timestamp}.part beside its run
+    directory, which is created and the note moved into it when done.
+    '''
+    df = df.copy()
+    if 'idx' in df.columns:
+        df = df.set_index('idx')
+    asyncio.run(generate_fanout_async(df, generators, root, slots, manifest, replicates))
+
+def parse_idxs(values):
+    return 'all' if values == ['all'] else [int(value) for value in values]
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Generate clinical notes for dataset transcripts with a model and prompt.')
+    parser.add_argument('--model', default=GENERATE_MODEL_NAME, help="'ozwell' or an Ollama model name")
+    parser.add_argument('--prompt', default=GENERATE_PROMPT_NAME, help='prompt under prompts/generation/')
+    parser.add_argument('--idxs', nargs='+', default=None, help="dataset idxs to generate notes for (or 'all')")
+    parser.add_argument('--replicates', type=int, default=REPLICATES, help='notes to generate per idx')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT or 0, help='requests kept in flight at once, 0 to generate one row at a time')
+    parser.add_argument('--rate-limit', type=float, default=None, help='max requests started per second (default: RATE_LIMITS for the backend)')
+    parser.add_argument('--fanout-models', nargs='+', default=FANOUT_MODELS, help='Ollama models to stream every transcript to at once instead of --model')
+    parser.add_argument('--slots', type=int, default=OLLAMA_SLOTS, help='generations running at once across --fanout-models')
+    parser.add_argument('--keep-alive', default=OLLAMA_KEEP_ALIVE, help='how long Ollama keeps each model loaded between requests')
+    parser.add_argument('--manifest', action=argparse.BooleanOptionalAction, default=USE_MANIFEST, help='record work in results/manifest.db and skip what it records as done')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help='dataset records loaded into memory at a time')
+    parser.add_argument('--cache', default=CACHE_PATH, help='completion cache to reuse identical earlier completions')
+    parser.add_argument('--packed-corpus', default=PACKED_CORPUS, help='store source fields other than FILE_FIELDS in this packed corpus instead of per-idx files')
+    args = parser.parse_args(argv)
+    idxs = IDXS if args.idxs is None else parse_idxs(args.idxs)
+    import requester # the model backends (requests, ollama) load only once generation actually starts
+
+    cache = CompletionCache(args.cache) if args.cache else None
+    run_telemetry = telemetry.Telemetry(TELEMETRY_PATH) if TELEMETRY_PATH else None
+    if args.fanout_models:
+        generators = [requester.AsyncOllamaRequester(model, args.prompt, keep_alive=args.keep_alive, cache=cache, telemetry=run_telemetry) for model in args.fanout_models]
+    elif args.model == 'ozwell':
+        generators = [requester.OzwellRequester(args.prompt, cache=cache, telemetry=run_telemetry)]
     else:
-        req_gen = requester.OllamaRequester(GENERATE_MODEL_NAME, GENERATE_PROMPT_NAME)
+        generators = [requester.OllamaRequester(args.model, args.prompt, keep_alive=args.keep_alive, cache=cache, telemetry=run_telemetry)]
     
-    df = pd.read_json('augmented-clinical-notes/augmented_notes_30K.jsonl', lines=True)
-    if IDXS != 'all':
-        df = df[df['idx'].isin(IDXS)].reset_index(drop=True)
-    df = df.set_index('idx')
-    init_dirs(df, root='./')
-    generate(df, req_gen)
+    for generator in generators:
+        if isinstance(generator, requester.OllamaRequester):
+            generator.preload()
+    manifest = RunManifest(os.path.join('results', 'manifest.db')) if args.manifest else None
+    rate_limit = args.rate_limit if args.rate_limit is not None else RATE_LIMITS.get(generators[0].backend)
+    corpus = PackedCorpus(args.packed_corpus) if args.packed_corpus else None
+    for df in dataset.iter_chunks(dataset.DATASET_PATH, idxs=idxs, chunksize=args.chunksize):
+        init_dirs(df, root='./', corpus=corpus)
+        if args.fanout_models:
+            generate_fanout(df, generators, slots=args.slots, manifest=manifest, replicates=args.replicates)
+        elif args.max_in_flight:
+            generate_concurrent(df, generators[0], max_in_flight=args.max_in_flight, rate_limit=rate_limit, manifest=manifest, replicates=args.replicates)
+        else:
+            generate(df, generators[0], manifest=manifest, replicates=args.replicates)
+    if manifest:
+        for generator in generators:
+            print(generator.model_name, manifest.summary(generator.model_name, generator.prompt_name))
+    if cache:
+        print(cache.stats())
+    if run_telemetry:
+        print(run_telemetry.write_report().to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import threading
+import time
+
+'''
+SQLite journal of planned generation work. Every (idx, model, prompt, replicate) of a run is recorded as pending,
+running, done or failed so an interrupted run can be restarted and only redo what did not finish.
+'''
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class RunManifest:
+    def __init__(self, path=os.path.join('results', 'manifest.db')):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS runs (
+                idx INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                replicate INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                path TEXT,
+                error TEXT,
+                updated REAL,
+                PRIMARY KEY (idx, model, prompt, replicate)
+            )''')
+
+    def plan(self, idxs, model, prompt, replicates=1):
+        '''Adds any (idx, model, prompt, replicate) not already in the manifest as pending.'''
+        rows = [(int(idx), model, prompt, r, PENDING, time.time()) for idx in idxs for r in range(replicates)]
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR IGNORE INTO runs (idx, model, prompt, replicate, status, updated) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.conn.execute('COMMIT')
+
+    def pending(self, model, prompt, idxs=None, replicates=None):
+        '''
+        Returns (idx, replicate, path) for every item that is not done. Items left running by a crashed run count as pending,
+        and path is the directory they were writing to (None if they never started). With replicates, items planned by an
+        earlier run with more replicates are left out.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT idx, replicate, path FROM runs WHERE model = ? AND prompt = ? AND status != ? ORDER BY idx, replicate', (model, prompt, DONE)).fetchall()
+        if replicates is not None:
+            rows = [row for row in rows if row[1] < replicates]
+        if idxs is not None:
+            idxs = set(map(int, idxs))
+            rows = [row for row in rows if row[0] in idxs]
+        return rows
+
+    def set_status(self, idx, model, prompt, replicate, status, path=None, error=None):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE runs SET status = ?, path = COALESCE(?, path), error = ?, updated = ? WHERE idx = ? AND model = ? AND prompt = ? AND replicate = ?',
+                (status, path, error, time.time(), int(idx), model, prompt, replicate)
+            )
+
+    def mark_running(self, idx, model, prompt, replicate, path):
+        self.set_status(idx, model, prompt, replicate, RUNNING, path=path)
+
+    def mark_done(self, idx, model, prompt, replicate, path=None):
+        self.set_status(idx, model, prompt, replicate, DONE, path=path)
+
+    def mark_failed(self, idx, model, prompt, replicate, error):
+        self.set_status(idx, model, prompt, replicate, FAILED, error=str(error))
+
+    def summary(self, model=None, prompt=None):
+        filters = {'model': model, 'prompt': prompt}
+        filters = {k: v for k, v in filters.items() if v is not None}
+        query = 'SELECT status, COUNT(*) FROM runs'
+        if filters:
+            query += ' WHERE ' + ' AND '.join(f'{k} = ?' for k in filters)
+        with self.lock:
+            return dict(self.conn.execute(query + ' GROUP BY status', list(filters.values())).fetchall())
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,109 @@
+import os
+import inspect
+import sqlite3
+import threading
+from collections import OrderedDict
+from cache import make_key
+
+'''
+Cache of note text and of the representations built from it (ROUGE documents, TF-IDF vectors), keyed by the note's resolved
+path, mtime, size and whether it was cleaned, so a standard compared against many generated notes is read, cleaned and
+tokenized once. Entries live in an in-process LRU; the cleaned text of standards can also be kept on disk (path=...) so
+worker processes and later runs skip the cleaning too. Disk entries are also keyed by the cleaning function's source, so
+editing it invalidates them.
+'''
+NOTE_CACHE_PATH = os.path.join('cache', 'notes.db')
+
+
+_CLEANER_KEYS = {}
+
+def cleaner_key(clean_fn):
+    '''Hash of clean_fn's source code (its qualified name if the source is unavailable).'''
+    fn = getattr(clean_fn, '__func__', clean_fn)
+    if fn not in _CLEANER_KEYS:
+        try:
+            _CLEANER_KEYS[fn] = make_key(inspect.getsource(fn))
+        except (OSError, TypeError):
+            _CLEANER_KEYS[fn] = make_key(fn.__module__, fn.__qualname__)
+    return _CLEANER_KEYS[fn]
+
+
+class NoteCache:
+    def __init__(self, max_entries=4096, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS notes (key TEXT PRIMARY KEY, text TEXT NOT NULL)')
+
+    def note_key(self, path, clean):
+        stat = os.stat(path)
+        return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size, clean)
+
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+            self.misses += 1
+        return False, None
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def text(self, path, clean_fn=None, persist=False):
+        '''
+        The text of the note at path, passed through clean_fn if given. With persist (meant for standards, which many notes
+        are compared against), cleaned text is also kept in the disk cache.
+        '''
+        key = (*self.note_key(path, clean_fn is not None), 'text')
+        found, text = self.lookup(key)
+        if found:
+            return text
+        disk_key = make_key(*key, cleaner_key(clean_fn)) if self.conn is not None and persist and clean_fn is not None else None
+        if disk_key is not None:
+            with self.lock:
+                row = self.conn.execute('SELECT text FROM notes WHERE key = ?', (disk_key,)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                self.store(key, row[0])
+                return row[0]
+        with open(path, 'r') as file:
+            text = file.read()
+        if clean_fn is not None:
+            text = clean_fn(text)
+        if disk_key is not None:
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO notes VALUES (?, ?)', (disk_key, text))
+        self.store(key, text)
+        return text
+
+    def artifact(self, path, kind, build, clean=False):
+        '''A representation of the note at path (e.g. kind='rouge'), built by build() on a miss and kept in memory only.'''
+        key = (*self.note_key(path, clean), kind)
+        found, value = self.lookup(key)
+        if not found:
+            value = build()
+            self.store(key, value)
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits, 'entries': len(self.entries)}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,165 @@
+import os
+import re
+import sqlite3
+import threading
+import argparse
+import time
+
+'''
+Persistent index of the files under results/{idx}/{model}/{prompt}/{timestamp}/. It lives in results/paths.db, is rebuilt with
+one os.scandir walk (python path_index.py rebuild) and is kept up to date by record(), which generate.py and evaluate.py
+call for every file they write. Once it exists, utils.search_file_paths answers queries from it instead of globbing, after a
+refresh() that picks up files added or removed by anything else (git pull, rsync, rm) from the directories' mtimes.
+'''
+INDEX_FILENAME = 'paths.db'
+TIMESTAMP_PATTERN = re.compile(r'\d+\.\d+$')
+RACY_SECONDS = 2 # directories modified this recently are listed again on the next refresh (coarse file system mtimes)
+
+
+class PathIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS paths (
+                idx INTEGER, model TEXT, prompt TEXT, timestamp TEXT, artifact TEXT,
+                PRIMARY KEY (artifact, model, prompt, idx, timestamp)
+            );
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER
+            );
+        ''')
+
+    def add(self, idx, model, prompt, timestamp, artifact):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO paths VALUES (?, ?, ?, ?, ?)', (int(idx), model, prompt, timestamp, artifact))
+
+    def rebuild(self, results_dir):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM paths')
+            self.conn.execute('DELETE FROM dirs')
+            self.conn.execute('COMMIT')
+        self.refresh(results_dir)
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM paths').fetchone()[0]
+
+    def refresh(self, results_dir, idxs='all'):
+        '''
+        Brings the index up to date with results_dir (only the subtrees of idxs, if given). Every indexed directory is stat'ed
+        and only those whose mtime changed since they were last listed are listed again, so files copied in from elsewhere
+        are picked up and deleted ones dropped without walking the whole tree. Returns the number of directories listed.
+        '''
+        if idxs != 'all':
+            idxs = {str(int(idx)) for idx in (idxs if isinstance(idxs, list) else [idxs])}
+        with self.lock:
+            known = dict(self.conn.execute('SELECT path, mtime_ns FROM dirs').fetchall())
+        children = {}
+        for path in known:
+            if path:
+                children.setdefault(path.rsplit('/', 1)[0] if '/' in path else '', []).append(path)
+        now = time.time_ns()
+        listed, set_dirs, removed, artifacts = 0, {}, [], {}
+        stack = ['']
+        while stack:
+            path = stack.pop()
+            depth = path.count('/') + 1 if path else 0
+            try:
+                mtime = os.stat(os.path.join(results_dir, path)).st_mtime_ns
+            except FileNotFoundError:
+                removed.append(path)
+                continue
+            if mtime == known.get(path):
+                subdirs = children.get(path, [])
+            else:
+                listed += 1
+                # a directory changed within the last RACY_SECONDS may change again without its mtime moving, so list it again next time
+                set_dirs[path] = mtime if now - mtime > RACY_SECONDS * 1e9 else None
+                entries = list(os.scandir(os.path.join(results_dir, path)))
+                if depth == 4:
+                    artifacts[path] = [entry.name for entry in entries if entry.is_file()]
+                    continue
+                subdirs = [f'{path}/{entry.name}' if path else entry.name for entry in entries if entry.is_dir() and (depth != 0 or entry.name.isdigit()) and (depth != 3 or TIMESTAMP_PATTERN.match(entry.name))]
+                removed.extend(set(children.get(path, [])) - set(subdirs))
+                set_dirs.update({subdir: None for subdir in subdirs if subdir not in known})
+            stack.extend(subdir for subdir in subdirs if depth != 0 or idxs == 'all' or subdir in idxs)
+        if not (set_dirs or removed or artifacts):
+            return listed
+        with self.lock:
+            self.conn.execute('BEGIN')
+            for path in removed:
+                self.conn.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(path) + 1, path + '/'))
+                self.delete_paths(path)
+            self.conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)', set_dirs.items())
+            for path, names in artifacts.items():
+                self.delete_paths(path)
+                self.conn.executemany('INSERT OR IGNORE INTO paths VALUES (?, ?, ?, ?, ?)', [(*self.columns(path), name) for name in names])
+            self.conn.execute('COMMIT')
+        return listed
+
+    def columns(self, path):
+        parts = path.split('/')
+        return (int(parts[0]), *parts[1:])
+
+    def delete_paths(self, path):
+        '''Drops the indexed files under the results-relative directory path (an idx, model, prompt or timestamp directory).'''
+        values = self.columns(path) if path else ()
+        clauses = [f'{column} = ?' for column in ('idx', 'model', 'prompt', 'timestamp')[:len(values)]]
+        self.conn.execute('DELETE FROM paths' + (f' WHERE {" AND ".join(clauses)}' if clauses else ''), values)
+
+    def search(self, artifact, idxs='all', models='all', prompts='all'):
+        '''Returns (idx, model, prompt, timestamp) for every indexed artifact matching the filters. prompts='all' means every generation prompt (g1, g2, ...).'''
+        clauses, params = ['artifact = ?'], [artifact]
+        for column, values in (('model', models), ('prompt', prompts), ('idx', idxs)):
+            if values == 'all':
+                continue
+            values = values if isinstance(values, list) else [values]
+            clauses.append(f'{column} IN ({", ".join("?" * len(values))})')
+            params.extend(int(v) if column == 'idx' else str(v) for v in values)
+        if prompts == 'all':
+            clauses.append("prompt GLOB 'g[0-9]*'")
+        query = f'SELECT idx, model, prompt, timestamp FROM paths WHERE {" AND ".join(clauses)} ORDER BY idx, model, prompt, timestamp'
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def runs(self, artifact='gen_note.txt'):
+        '''(idx, model, prompt, timestamp) of every indexed timestamp directory holding artifact, whatever its prompt.'''
+        with self.lock:
+            return self.conn.execute('SELECT idx, model, prompt, timestamp FROM paths WHERE artifact = ?', (artifact,)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+def get_index(results_dir='results', create=False):
+    '''Returns the index of results_dir, or None if it has none and create is False.'''
+    # keyed by pid too: a worker process must open its own connection rather than reuse one inherited through fork
+    path = (os.getpid(), os.path.normpath(os.path.join(results_dir, INDEX_FILENAME)))
+    with _INDEXES_LOCK:
+        if path not in _INDEXES:
+            if not create and not os.path.exists(path[1]):
+                return None
+            _INDEXES[path] = PathIndex(path[1])
+        return _INDEXES[path]
+
+def record(path):
+    '''Adds a newly written results/{idx}/{model}/{prompt}/{timestamp}/{artifact} file to the index of its results directory, if there is one.'''
+    parts = os.path.normpath(path).split(os.sep)
+    if len(parts) < 6 or not parts[-5].isdigit():
+        return
+    index = get_index(os.sep.join(parts[:-5]) or '.')
+    if index is not None:
+        index.add(*parts[-5:])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the path index of a results directory.')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--results-dir', default='results')
+    args = parser.parse_args()
+    print(f'Indexed {get_index(args.results_dir, create=True).rebuild(args.results_dir)} files')
@@ -1,11 +1,10 @@
-import seaborn as sns
-import matplotlib.pyplot as plt
-from utils import get_rouge_report, search_file_paths, melt_rouge_scores, get_standard_path, parse_path, get_most_recent_timestamp
+from utils import search_rouge_reports, get_most_recent_timestamps, load_rouge_reports, get_standards_registry, categorize
 import pandas as pd
-import os
+import argparse
 
 
 RESULTS_DIR = 'results'
+RESULTS_STORE = None # path of a results store (see store.py) to load scores from in one query, or None to read the rouge.json reports
 IDXS = 'all' # or 'all'
 MODEL_NAMES = ['ozwell'] # list of model names to include in the plot
 PROMPT_NAMES = ['g1', 'g2'] # list of prompt names to include in the plot
@@ -19,40 +18,76 @@ ROUGE_TYPES = ['rouge-1', 'rouge-2', 'rouge-l']
 
 def aggr_standards(df, method):
     if method == 'avg':
-        df = df.groupby([c for c in df.columns if c not in ['standard_note_path', 'score']])['score'].mean().reset_index()
+        df = df.groupby([c for c in df.columns if c not in ['standard_note_path', 'score']], observed=True)['score'].mean().reset_index()
     elif method == 'use_set':
-        df = df[df['standard_note_path'] == df['idx'].map(get_standard_path)].reset_index(drop=True)
+        registry = get_standards_registry()
+        standards = registry.refresh()
+        missing = sorted(set(df['idx'].astype(object).unique()) - set(standards))
+        if missing:
+            raise FileNotFoundError(f'Standard note for idxs {", ".join(map(str, missing))} not found in {registry.standard_dir}')
+        df = df[df['standard_note_path'].astype(object) == df['idx'].astype(object).map(standards)].reset_index(drop=True)
     return df
 
 def aggr_timestamps(df, method):
     if method == 'avg':
-        df = df.groupby([c for c in df.columns if c not in ['timestamp', 'score']])['score'].mean().reset_index()
+        df = df.groupby([c for c in df.columns if c not in ['timestamp', 'score']], observed=True)['score'].mean().reset_index()
     elif method == 'most_recent':
-        timestamp_idx = df.apply(lambda row: get_most_recent_timestamp(row['root_dir'], row['model'], row['prompt'], row['idx']), axis=1)
-        df = df[df['timestamp'] == timestamp_idx].reset_index(drop=True)
+        latest = pd.DataFrame(
+            [(root_dir, *key, timestamp) for root_dir in df['root_dir'].unique() for key, timestamp in get_most_recent_timestamps(root_dir).items()],
+            columns=['root_dir', 'idx', 'model', 'prompt', 'timestamp']
+        )
+        keys = ['root_dir', 'idx', 'model', 'prompt', 'timestamp']
+        is_latest = df[keys].astype(object).merge(latest.astype(object), on=keys, how='left', indicator=True)['_merge'] == 'both'
+        df = df[is_latest.to_numpy()].reset_index(drop=True)
     return df
 
 def plotter(df, x_category, color_category, save_path, col_name, row_name):
+    import seaborn as sns # loaded only when a plot is drawn
+    df = df.apply(lambda col: col.cat.remove_unused_categories() if isinstance(col.dtype, pd.CategoricalDtype) else col)
     g = sns.catplot(data=df, x=x_category, y='score', hue=color_category, col=col_name, row=row_name, dodge=True, legend='full', aspect=1.5)
     g.savefig(save_path)
 
 
-if __name__ == '__main__':
-    if STANDARDS_AGGR:
-        assert X_CATEGORY != 'standard_note_path', "Cannot use 'standard_note_path' as X_CATEGORY when STANDARDS_AGGR is set"
-        assert COLOR_CATEGORY != 'standard_note_path', "Cannot use 'standard_note_path' as COLOR_CATEGORY when STANDARDS_AGGR is set"
-    if TIMESTAMP_AGGR:
-        assert X_CATEGORY != 'timestamp', "Cannot use 'timestamp' as X_CATEGORY when TIMESTAMP_AGGR is set"
-        assert COLOR_CATEGORY != 'timestamp', "Cannot use 'timestamp' as COLOR_CATEGORY when TIMESTAMP_AGGR is set"
-
-    eval_df = []
-    for rouge_type in ROUGE_TYPES:
-        eval_report_paths = search_file_paths(filename=f'{rouge_type}.json', results_dir_path=RESULTS_DIR, idxs=IDXS, models=MODEL_NAMES, prompts=PROMPT_NAMES)
-        eval_df.extend(list(map(get_rouge_report, eval_report_paths)))
-    eval_df = pd.concat(eval_df).reset_index(drop=True)
-    if STANDARDS_AGGR:
-        eval_df = aggr_standards(eval_df, STANDARDS_AGGR)
-    if TIMESTAMP_AGGR:
-        eval_df = aggr_timestamps(eval_df, TIMESTAMP_AGGR)
-    plotter(eval_df, X_CATEGORY, COLOR_CATEGORY, SAVE_PATH, 'rouge_type', 'metric_type')
+def search_arg(values):
+    return 'all' if values == ['all'] else values
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Plot ROUGE scores of generated notes.')
+    parser.add_argument('--idxs', nargs='+', default=None, help="idxs to include (or 'all')")
+    parser.add_argument('--models', nargs='+', default=MODEL_NAMES, help="models to include (or 'all')")
+    parser.add_argument('--prompts', nargs='+', default=PROMPT_NAMES, help="prompts to include (or 'all')")
+    parser.add_argument('--rouge-types', nargs='+', default=ROUGE_TYPES)
+    parser.add_argument('--standards-aggr', choices=['avg', 'use_set', 'none'], default=STANDARDS_AGGR or 'none', help='see STANDARDS_AGGR')
+    parser.add_argument('--timestamp-aggr', choices=['avg', 'most_recent', 'none'], default=TIMESTAMP_AGGR or 'none', help='see TIMESTAMP_AGGR')
+    parser.add_argument('--x-category', default=X_CATEGORY, help="column on the x axis: 'model', 'prompt', 'idx', ...")
+    parser.add_argument('--color-category', default=COLOR_CATEGORY, help='column the points are colored by')
+    parser.add_argument('--save-path', default=SAVE_PATH)
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--store', default=RESULTS_STORE, help='results store to load scores from instead of the rouge.json reports')
+    args = parser.parse_args(argv)
+    idxs = IDXS if args.idxs is None else search_arg(args.idxs)
+    models, prompts = search_arg(args.models), search_arg(args.prompts)
+    standards_aggr = None if args.standards_aggr == 'none' else args.standards_aggr
+    timestamp_aggr = None if args.timestamp_aggr == 'none' else args.timestamp_aggr
+
+    if standards_aggr:
+        assert args.x_category != 'standard_note_path', "Cannot use 'standard_note_path' as X_CATEGORY when STANDARDS_AGGR is set"
+        assert args.color_category != 'standard_note_path', "Cannot use 'standard_note_path' as COLOR_CATEGORY when STANDARDS_AGGR is set"
+    if timestamp_aggr:
+        assert args.x_category != 'timestamp', "Cannot use 'timestamp' as X_CATEGORY when TIMESTAMP_AGGR is set"
+        assert args.color_category != 'timestamp', "Cannot use 'timestamp' as COLOR_CATEGORY when TIMESTAMP_AGGR is set"
 
+    if args.store:
+        from store import ResultsStore
+        eval_df = categorize(ResultsStore(args.store).load_rouge(idxs=idxs, models=models, prompts=prompts, rouge_types=args.rouge_types))
+    else:
+        eval_df = load_rouge_reports(search_rouge_reports(args.results_dir, idxs, models, prompts), args.rouge_types)
+    if standards_aggr:
+        eval_df = aggr_standards(eval_df, standards_aggr)
+    if timestamp_aggr:
+        eval_df = aggr_timestamps(eval_df, timestamp_aggr)
+    plotter(eval_df, args.x_category, args.color_category, args.save_path, 'rouge_type', 'metric_type')
+
+
+if __name__ == '__main__':
+    main()
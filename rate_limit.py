@@ -0,0 +1,41 @@
+import time
+import threading
+
+'''
+Request rate limiting shared across threads. Kept apart from requester.py so the evaluator can limit judge calls without
+importing the generation backends.
+'''
+
+
+class RateLimiter:
+    '''Spaces out calls so that at most `rate` calls per second are started across all threads sharing it.'''
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        '''Blocks until the next call may start. Returns the seconds waited.'''
+        if not self.interval:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            wait_time = max(0.0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time:
+            time.sleep(wait_time)
+        return wait_time
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(backend, rate=None):
+    '''
+    Returns the limiter shared by every requester of a backend at `rate`. Limiters are keyed by (backend, rate), so a later
+    caller asking for a different rate (e.g. evaluate after generate in one process) gets its own instead of the first one's.
+    '''
+    key = (backend, float(rate) if rate else None)
+    with _RATE_LIMITERS_LOCK:
+        if key not in _RATE_LIMITERS:
+            _RATE_LIMITERS[key] = RateLimiter(rate)
+        return _RATE_LIMITERS[key]
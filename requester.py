@@ -1,22 +1,96 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from abc import ABC, abstractmethod
-from ollama import Client
+from ollama import Client, AsyncClient, ResponseError
+import asyncio
+import httpx
 import re
 from dotenv import load_dotenv
-import pandas as pd
+from email.utils import parsedate_to_datetime
+from cache import make_key
+import telemetry
+import random
+import time
+
+OZWELL_URL = 'https://ai.bluehive.com/api/v1/completion'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+STREAM_FLUSH_SECONDS = 0.5 # how often a streamed completion's buffered tokens are appended to its .part file
+
+class RetryableError(Exception):
+    '''Raised for failures worth retrying (connection errors, timeouts, 429/5xx responses).'''
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 class Requester(ABC):
-    def __init__(self, model_name, prompt_name, args=None, root_dir='./'):
+    backend = None
+
+    def __init__(self, model_name, prompt_name, args=None, root_dir='./', timeout=(10, 300), max_retries=5, backoff=1.0, max_backoff=60.0, pool_size=32, cache=None, telemetry=None):
+        '''
+        timeout is a (connect, read) pair in seconds. Failed calls are retried up to max_retries times,
+        waiting a random time up to backoff * 2**attempt (capped at max_backoff) or whatever Retry-After asks for.
+        cache is an optional cache.CompletionCache that send checks before calling the model.
+        telemetry is an optional telemetry.Telemetry that records every send.
+        '''
         self.root_dir = root_dir
+        self.cache = cache
+        self.telemetry = telemetry
         self.model_name = model_name
         self.set_prompt(prompt_name)
         self.header = self.build_header(args)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = self.build_session(pool_size)
     
     @abstractmethod
     def build_header(self, args):
         pass
 
+    def build_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.header)
+        return session
+
+    def retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(self.max_backoff, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def with_retries(self, call):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return call()
+            except RetryableError as e:
+                if attempt == self.max_retries:
+                    raise
+                telemetry.count('retries')
+                time.sleep(self.retry_delay(attempt, e.retry_after))
+
+    def post(self, url, payload):
+        def call():
+            try:
+                resp = self.session.post(url, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise RetryableError(str(e)) from e
+            telemetry.annotate(http_status=resp.status_code)
+            if resp.status_code in RETRY_STATUSES:
+                raise RetryableError(f'Response status: {resp.status_code}', resp.headers.get('Retry-After'))
+            resp.raise_for_status()
+            return resp
+        return self.with_retries(call)
+
     def set_prompt(self, prompt_name):
         prompt_type = prompt_name[0].lower()
         assert prompt_type in ['s', 'g']
@@ -27,48 +101,89 @@ class Requester(ABC):
         with open(prompt_path, 'r') as file:
             self.prompt = file.read()
 
+    def send(self, data, use_cache=True):
+        '''Returns the model's completion for data, served from the cache when possible. Pass use_cache=False for deliberate replicates.'''
+        if self.cache is None or not use_cache:
+            return self.timed_complete(data)
+        key = make_key(self.backend, self.model_name, self.prompt, data)
+        content = self.cache.get(key)
+        if content is None:
+            content = self.timed_complete(data)
+            self.cache.set(key, content)
+        else:
+            with telemetry.span(self.telemetry, self.backend, self.model_name, self.prompt_name) as record:
+                record['cache_hit'] = True
+        return content
+
+    def timed_complete(self, data):
+        with telemetry.span(self.telemetry, self.backend, self.model_name, self.prompt_name):
+            return self.complete(data)
+
     @abstractmethod
-    def send(self, data):
+    def complete(self, data):
         pass
 
 class OzwellRequester(Requester):
-    def __init__(self, prompt_name, root_dir='./'):
+    backend = 'ozwell'
+
+    def __init__(self, prompt_name, root_dir='./', url=OZWELL_URL, **kwargs):
         load_dotenv()
         api_key = os.getenv("OZWELL_SECRET_KEY")
-        super().__init__('ozwell', prompt_name, {'api_key': api_key}, root_dir)
+        self.url = url
+        super().__init__('ozwell', prompt_name, {'api_key': api_key}, root_dir, **kwargs)
     
     def build_header(self, args):
         return {"Authorization": f"Bearer {args['api_key']}", "Content-Type": "application/json"}
 
-    def send(self, data):
-        url = 'https://ai.bluehive.com/api/v1/completion'
+    def complete(self, data):
         payload = {"prompt": self.prompt, "systemMessage": data}
-        resp = requests.post(url, headers=self.header, json=payload)
-        resp = resp.json()
+        resp = self.post(self.url, payload).json()
+        usage = resp.get('usage') if isinstance(resp, dict) else None
+        if usage:
+            telemetry.annotate(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
         try:
-            content = resp['choices'][0]['message']['content']
-        except:
-            status_code = resp.status_code
-            print(f'Response status: {status_code}')
-        return content
+            return resp['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f'Unexpected response from {self.url}: {resp}') from e
+
+def write_text(path, text, mode='w'):
+    with open(path, mode) as f:
+        f.write(text)
+
+def annotate_ollama(response):
+    '''
+    Token counts and timings of a finished Ollama generation. The system prompt always comes first and the model is kept
+    loaded, so Ollama reuses the cached prefix across notes; that shows up as a short prompt_eval_seconds.
+    '''
+    seconds = lambda ns: ns / 1e9 if ns is not None else None
+    telemetry.annotate(prompt_tokens=response.prompt_eval_count, completion_tokens=response.eval_count,
+                       prompt_eval_seconds=seconds(response.prompt_eval_duration), load_seconds=seconds(response.load_duration))
+
 class OllamaRequester(Requester):
-    def __init__(self, model_name, prompt_name, root_dir='./'):
-        if re.search(r'-cloud$', self.model_name):
+    backend = 'ollama'
+
+    def __init__(self, model_name, prompt_name, root_dir='./', host=None, keep_alive=None, **kwargs):
+        '''keep_alive is how long Ollama keeps the model loaded after a request (e.g. '30m'), None for the server default.'''
+        self.keep_alive = keep_alive
+        if re.search(r'-cloud$', model_name):
             load_dotenv()
             args = {'api_key': os.getenv("OZWELL_SECRET_KEY")}
-            host='https://ollama.com'
+            host = host or 'https://ollama.com'
         else:
             args = None
-            host='http://localhost:11434'
-        super().__init__(model_name, prompt_name, args, root_dir)
+            host = host or 'http://localhost:11434'
+        super().__init__(model_name, prompt_name, args, root_dir, **kwargs)
+        self.host = host
+        connect_timeout, read_timeout = self.timeout
         self.client = Client(
             host=host,
-            headers=self.header
+            headers=self.header,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
         )
 
-    def build_header(self, api_key):
-        if api_key:
-            return {"Authorization": f"{api_key}", "Content-Type": "application/json"}
+    def build_header(self, args):
+        if args:
+            return {"Authorization": f"{args['api_key']}", "Content-Type": "application/json"}
         else:
             return {"Content-Type": "application/json"}
     
@@ -78,9 +193,129 @@ class OllamaRequester(Requester):
             formatted_data += f'* Text {i+1}:\n"""\n{x}\n"""\n\n'
         return formatted_data
 
-    def send(self, data):
+    def generate_with_retries(self, **kwargs):
+        '''client.generate for this model, retried like post on connection errors, timeouts and 429/5xx responses.'''
+        def call():
+            try:
+                return self.client.generate(model=self.model_name, keep_alive=self.keep_alive, **kwargs)
+            except ResponseError as e:
+                if e.status_code in RETRY_STATUSES:
+                    raise RetryableError(str(e)) from e
+                raise
+            except (ConnectionError, httpx.TimeoutException) as e:
+                raise RetryableError(str(e)) from e
+        return self.with_retries(call)
+
+    def complete(self, data):
         if isinstance(data, tuple):
             data = self.format_tuple(data)
-        response = self.client.generate(model=self.model_name, system=self.prompt, prompt=data, stream=False)
+        response = self.generate_with_retries(system=self.prompt, prompt=data, stream=False)
+        annotate_ollama(response)
         return response.response
 
+    def preload(self):
+        '''
+        Loads the model and keeps it loaded for keep_alive, so the first note does not pay the load time. Best effort: returns
+        False (and the first request loads the model instead) if the server cannot be reached after the usual retries.
+        '''
+        try:
+            self.generate_with_retries()
+            return True
+        except Exception as e:
+            print(f'Could not preload {self.model_name}: {e}')
+            return False
+
+class AsyncOllamaRequester(OllamaRequester):
+    '''
+    OllamaRequester with a streaming asyncio interface. asend streams the completion into {path}.part (or another partial
+    file) as tokens arrive, moves it to path when the note is complete and records the time to first token, so many requests (and several models)
+    can be in flight from one thread. The synchronous send still works.
+    '''
+    def __init__(self, model_name, prompt_name, root_dir='./', host=None, keep_alive='30m', **kwargs):
+        super().__init__(model_name, prompt_name, root_dir, host, keep_alive=keep_alive, **kwargs)
+        self.async_client = None
+        self.async_loop = None
+
+    def get_async_client(self):
+        # an AsyncClient is bound to the event loop it was first used on, so each asyncio.run gets its own
+        loop = asyncio.get_running_loop()
+        if self.async_loop is not loop:
+            connect_timeout, read_timeout = self.timeout
+            self.async_client = AsyncClient(host=self.host, headers=self.header, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+            self.async_loop = loop
+        return self.async_client
+
+    async def stream(self, data, path=None, partial=None):
+        '''
+        Streams one completion, into partial (default {path}.part) if path is given, which is moved to path when complete and
+        removed if the stream fails. path's directory is only created once the completion is.
+        '''
+        partial = partial or f'{path}.part' if path else None
+        try:
+            content = await self.stream_to(data, partial)
+        except BaseException:
+            if partial and os.path.exists(partial):
+                os.remove(partial)
+            raise
+        if partial:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            os.replace(partial, path)
+        return content
+
+    async def stream_to(self, data, partial=None):
+        start = time.perf_counter()
+        parts = []
+        written, flushed_at = 0, start
+        try:
+            response = await self.get_async_client().generate(model=self.model_name, system=self.prompt, prompt=data, stream=True, keep_alive=self.keep_alive)
+            async for chunk in response:
+                if chunk.response:
+                    if not parts:
+                        telemetry.annotate(first_token_seconds=time.perf_counter() - start)
+                    parts.append(chunk.response)
+                # tokens are buffered and appended off the event loop every STREAM_FLUSH_SECONDS rather than written one by one
+                if partial and len(parts) > written and time.perf_counter() - flushed_at >= STREAM_FLUSH_SECONDS:
+                    await asyncio.to_thread(write_text, partial, ''.join(parts[written:]), 'a' if written else 'w')
+                    written, flushed_at = len(parts), time.perf_counter()
+                if chunk.done:
+                    annotate_ollama(chunk)
+        except ResponseError as e:
+            if e.status_code in RETRY_STATUSES:
+                raise RetryableError(str(e)) from e
+            raise
+        except (ConnectionError, httpx.TimeoutException, httpx.RemoteProtocolError) as e:
+            raise RetryableError(str(e)) from e
+        if partial:
+            await asyncio.to_thread(write_text, partial, ''.join(parts[written:]), 'a' if written else 'w')
+        return ''.join(parts)
+
+    async def asend(self, data, path=None, use_cache=True, partial=None):
+        '''
+        Async send that streams the completion to path (if given, through partial as in stream) as it is generated. Failed
+        streams are retried from the start with the same backoff as send. Returns the completion.
+        '''
+        if isinstance(data, tuple):
+            data = self.format_tuple(data)
+        key = make_key(self.backend, self.model_name, self.prompt, data) if self.cache is not None and use_cache else None
+        content = self.cache.get(key) if key else None
+        if content is not None:
+            with telemetry.span(self.telemetry, self.backend, self.model_name, self.prompt_name, 'stream') as record:
+                record['cache_hit'] = True
+            if path:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(content)
+            return content
+        with telemetry.span(self.telemetry, self.backend, self.model_name, self.prompt_name, 'stream'):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    content = await self.stream(data, path, partial)
+                    break
+                except RetryableError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    telemetry.count('retries')
+                    await asyncio.sleep(self.retry_delay(attempt, e.retry_after))
+        if key:
+            self.cache.set(key, content)
+        return content
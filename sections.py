@@ -0,0 +1,111 @@
+import re
+
+'''
+Splits clinical notes into sections by their headings ("**Medications:**", "ALLERGIES:", "## Assessment and Plan", ...) and
+aligns the sections of two notes, so the LLM judge can compare a long note pair as several short section pairs. Only
+headings that name a known section start one; anything before the first heading, or under sections the other note does
+not have, is compared as one remaining pair. Notes without enough recognizable headings (e.g. narrative reference notes)
+do not align, and are judged whole.
+'''
+SECTION_TITLES = { # canonical section: headings (case-insensitive) that start it
+    'history': ['chief complaint', 'presenting complaint', 'reason for visit', 'history of present illness', 'hpi', 'history', 'subjective',
+                'past medical history', 'medical history', 'past surgical history', 'surgical history', 'social history', 'family history'],
+    'medications': ['medications', 'medication', 'meds', 'current medications', 'home medications', 'prescriptions', 'medications prescribed'],
+    'allergies': ['allergies', 'allergy', 'drug allergies'],
+    'exam': ['examination', 'physical examination', 'physical exam', 'exam', 'clinical findings', 'objective', 'vital signs', 'vitals', 'review of systems', 'ros'],
+    'results': ['results', 'labs', 'lab results', 'laboratory', 'laboratory results', 'test results', 'investigations', 'diagnostics',
+                'diagnostic tests', 'diagnostic results', 'imaging', 'radiology'],
+    'assessment_plan': ['assessment', 'assessment and plan', 'assessment & plan', 'assessment/plan', 'impression', 'diagnosis', 'diagnoses',
+                        'differential diagnosis', 'plan', 'treatment', 'treatment plan', 'management', 'procedure', 'procedures',
+                        'recommendations', 'follow-up', 'follow up', 'disposition'],
+}
+MIN_SHARED_SECTIONS = 2 # sections both notes must have for them to be compared section by section
+SEPARATOR = '\n\n' # between the parts of a section that occurs more than once in a note
+OTHER = 'other'
+
+_TITLES = {title: section for section, titles in SECTION_TITLES.items() for title in titles}
+# a known title at the start of a line, optionally as a markdown heading or in bold, followed by a colon or the end of the line
+HEADING_PATTERN = re.compile(
+    r'^[ \t]*(?:#{1,6}[ \t]*)?(?:\*\*|__)?[ \t]*(?P<title>' + '|'.join(re.escape(t) for t in sorted(_TITLES, key=len, reverse=True)) + r')[ \t]*(?:\*\*|__)?[ \t]*(?::|$)',
+    re.IGNORECASE | re.MULTILINE
+)
+
+
+def split_sections(text):
+    '''[(section, start, end)] covering text, in order. Text before the first heading belongs to OTHER.'''
+    starts = [(m.start(), _TITLES[m.group('title').lower()]) for m in HEADING_PATTERN.finditer(text)]
+    if not starts or starts[0][0] > 0:
+        starts.insert(0, (0, OTHER))
+    spans = []
+    for (start, section), (end, _) in zip(starts, starts[1:] + [(len(text), None)]):
+        if text[start:end].strip():
+            spans.append((section, start, end))
+    return spans
+
+def group_sections(text):
+    '''{section: [(start, end)]}; a section whose heading occurs more than once gets every span, adjacent ones merged.'''
+    groups = {}
+    for section, start, end in split_sections(text):
+        spans = groups.setdefault(section, [])
+        if spans and spans[-1][1] == start:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    return groups
+
+
+class SectionText:
+    '''The text of one or more spans of a document, joined by SEPARATOR, that maps offsets in it back to the document.'''
+    def __init__(self, doc, spans):
+        self.spans = spans
+        self.text = SEPARATOR.join(doc[start:end] for start, end in spans)
+
+    def to_document(self, offset):
+        position = 0
+        for start, end in self.spans:
+            if offset <= position + end - start:
+                return start + max(0, offset - position)
+            position += end - start + len(SEPARATOR)
+        return self.spans[-1][1]
+
+
+def align(doc_a, doc_b, min_shared=MIN_SHARED_SECTIONS):
+    '''
+    [(section, SectionText of doc_a, SectionText of doc_b)] for the sections both documents have, plus one OTHER pair for
+    everything else (a side with nothing left over is the whole document, so unmatched content is still judged against all
+    of the other note). None if the documents share fewer than min_shared sections.
+    '''
+    groups_a, groups_b = group_sections(doc_a), group_sections(doc_b)
+    shared = [section for section in SECTION_TITLES if section in groups_a and section in groups_b]
+    if len(shared) < min_shared:
+        return None
+    pairs = [(section, SectionText(doc_a, groups_a[section]), SectionText(doc_b, groups_b[section])) for section in shared]
+    rest_a = sorted(span for section, spans in groups_a.items() if section not in shared for span in spans)
+    rest_b = sorted(span for section, spans in groups_b.items() if section not in shared for span in spans)
+    if rest_a or rest_b:
+        pairs.append((OTHER, SectionText(doc_a, rest_a or [(0, len(doc_a))]), SectionText(doc_b, rest_b or [(0, len(doc_b))])))
+    return pairs
+
+
+def locate(finding, side, section, doc):
+    '''
+    A copy of finding whose evidence offsets_{side} ('A' or 'B') are [start, end] in doc rather than in the section text the
+    judge saw. The snippet is searched for first (in the section, then the whole document), falling back to the offsets the
+    judge reported; offsets that cannot be placed are dropped.
+    '''
+    evidence = dict(finding.get('evidence') or {})
+    snippet = evidence.get(f'snippet_{side}')
+    offsets = evidence.pop(f'offsets_{side}', None)
+    located = None
+    if snippet:
+        start = section.text.find(snippet)
+        if start >= 0:
+            located = [section.to_document(start), section.to_document(start + len(snippet))]
+        elif snippet in doc:
+            start = doc.index(snippet)
+            located = [start, start + len(snippet)]
+    if located is None and isinstance(offsets, list) and len(offsets) == 2 and all(isinstance(o, int) for o in offsets) and 0 <= offsets[0] <= offsets[1] <= len(section.text):
+        located = [section.to_document(offsets[0]), section.to_document(offsets[1])]
+    if located is not None:
+        evidence[f'offsets_{side}'] = located
+    return {**finding, 'evidence': evidence}
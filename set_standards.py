@@ -1,4 +1,6 @@
 import os
+import argparse
+from utils import get_standards_registry
 
 RESULTS_DIR = 'results'
 
@@ -9,15 +11,21 @@ def set_standard(idx, source_path, standard_dir='standards'):
     if os.path.islink(standard_path):
         os.unlink(standard_path)
     os.symlink(source_path, standard_path)
+    get_standards_registry(standard_dir).invalidate()
 
-if __name__ == '__main__':
+def main(argv=None, prog=None):
     '''Set standard notes for all indices in results directory to full_note.txt (i.e. reference notes).'''
-    for idx in os.listdir(RESULTS_DIR):
-        full_note_path = os.path.join(RESULTS_DIR, str(idx), 'full_note.txt')
-        if os.path.exists(full_note_path):
-            set_standard(idx, full_note_path)
-    
-    '''
-        Example usage for setting a single standard note:
-    '''
-    set_standard(155216, 'results/155216/full_note.txt')
+    parser = argparse.ArgumentParser(prog=prog, description='Point standards/{idx}.txt at the note each idx is evaluated against.')
+    parser.add_argument('--idxs', nargs='+', default=None, help='only these idxs (default: every idx in --results-dir)')
+    parser.add_argument('--filename', default='full_note.txt', help='note under results/{idx}/ to use as the standard')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--standard-dir', default='standards')
+    args = parser.parse_args(argv)
+    for idx in args.idxs or os.listdir(args.results_dir):
+        source_path = os.path.join(args.results_dir, str(idx), args.filename)
+        if os.path.exists(source_path):
+            set_standard(idx, source_path, args.standard_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import os
+import re
+import hashlib
+import argparse
+import numpy as np
+
+'''
+Local semantic similarity between generated and standard notes: TF-IDF vectors (sublinear tf, smoothed idf) compared by
+cosine. Notes are encoded a batch at a time with numpy, the vectors of standard notes are cached, and nothing leaves the
+machine. The idf weights are fitted once and saved to cache/tfidf.npz with a version (a hash of the weights) that the
+similarity reports' fingerprints record. The first run fits them on the standard notes set at the time; after that they are
+only refitted on request, so changing a standard does not re-score every note or make earlier scores incomparable.
+python similarity.py fit refits on the current standards, python similarity.py fit --dataset on every full_note of
+augmented_notes_30K.jsonl.
+'''
+SIMILARITY_MODEL_PATH = os.path.join('cache', 'tfidf.npz')
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+STANDARDS_SOURCE = 'standards' # weights fitted on the standard notes
+DATASET_SOURCE = 'dataset' # weights fitted on every full_note of the dataset
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class TfidfModel:
+    def __init__(self, vocab, idf, n_docs, source=None, version=None):
+        self.source = source # what the weights were fitted on: STANDARDS_SOURCE or DATASET_SOURCE
+        self.version = version or weights_version(vocab, idf)
+        self.vocab = {term: i for i, term in enumerate(vocab)}
+        self.idf = list(idf)
+        self.n_docs = n_docs
+        self.unseen_idf = np.log((1 + n_docs) / 1) + 1 # idf of a term that never occurred in the fitted corpus
+
+    @classmethod
+    def fit(cls, texts, source=None):
+        df = {}
+        n_docs = 0
+        for text in texts:
+            n_docs += 1
+            for term in set(tokenize(text)):
+                df[term] = df.get(term, 0) + 1
+        vocab = sorted(df)
+        idf = np.log((1 + n_docs) / (1 + np.array([df[term] for term in vocab], dtype=np.float64))) + 1
+        return cls(vocab, idf, n_docs, source)
+
+    @classmethod
+    def load(cls, path=SIMILARITY_MODEL_PATH):
+        data = np.load(path)
+        optional = lambda key: (str(data[key]) or None) if key in data else None
+        return cls(data['vocab'].tolist(), data['idf'], int(data['n_docs']), optional('source'), optional('version'))
+
+    def save(self, path=SIMILARITY_MODEL_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        vocab = sorted(self.vocab, key=self.vocab.get)[:len(self.idf)]
+        np.savez(path, vocab=np.array(vocab), idf=np.array(self.idf[:len(vocab)]), n_docs=self.n_docs, source=self.source or '', version=self.version)
+
+    def term_id(self, term):
+        if term not in self.vocab:
+            self.vocab[term] = len(self.idf)
+            self.idf.append(self.unseen_idf)
+        return self.vocab[term]
+
+    def encode(self, texts):
+        '''
+        Encodes a batch of texts in one pass. Returns one (term ids, weights) pair per text: sorted term ids and their
+        L2-normalized tf-idf weights.
+        '''
+        doc_ids, term_ids = [], []
+        for i, text in enumerate(texts):
+            terms = [self.term_id(term) for term in tokenize(text)]
+            doc_ids.extend([i] * len(terms))
+            term_ids.extend(terms)
+        codes = (np.array(doc_ids, dtype=np.int64) << 32) | np.array(term_ids, dtype=np.int64)
+        codes, counts = np.unique(codes, return_counts=True)
+        docs, terms = codes >> 32, codes & 0xFFFFFFFF
+        weights = (1 + np.log(counts)) * np.asarray(self.idf)[terms]
+        bounds = np.searchsorted(docs, np.arange(len(texts) + 1))
+        vectors = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            w = weights[start:end]
+            norm = np.sqrt(np.dot(w, w))
+            vectors.append((terms[start:end], w / norm if norm else w))
+        return vectors
+
+
+def weights_version(vocab, idf):
+    '''Hash of a set of idf weights, which identifies them in report fingerprints.'''
+    digest = hashlib.sha256('\n'.join(vocab).encode('utf-8'))
+    digest.update(np.asarray(idf, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def cosine(a, b):
+    _, a_idx, b_idx = np.intersect1d(a[0], b[0], assume_unique=True, return_indices=True)
+    return float(np.dot(a[1][a_idx], b[1][b_idx]))
+
+
+class SemanticScorer:
+    def __init__(self, model):
+        self.model = model
+        self.references = {}
+
+    def reference(self, text):
+        if text not in self.references:
+            self.references[text] = self.model.encode([text])[0]
+        return self.references[text]
+
+    def score(self, hyp_text, ref_text):
+        return self.score_pairs([(hyp_text, ref_text)])[0]
+
+    def score_pairs(self, pairs):
+        '''Scores (generated, standard) text pairs. Generated notes are encoded as one batch; standards are encoded once and reused. Returns [{'cosine'}].'''
+        return self.score_vectors([hyp for hyp, _ in pairs], [self.reference(ref) for _, ref in pairs])
+
+    def score_vectors(self, hyp_texts, ref_vectors):
+        '''Like score_pairs, for standards already encoded by this scorer's model.'''
+        return [{'cosine': cosine(hyp, ref)} for hyp, ref in zip(self.model.encode(hyp_texts), ref_vectors)]
+
+
+def fit_standards():
+    '''Fits idf weights on the currently set standard notes.'''
+    from utils import get_standard_map, read
+    return TfidfModel.fit((read(p) for p in sorted(set(get_standard_map().values()))), STANDARDS_SOURCE)
+
+def get_model(path=SIMILARITY_MODEL_PATH):
+    '''Loads the saved idf weights, fitting them on the current standard notes first if there are none.'''
+    if os.path.exists(path):
+        return TfidfModel.load(path)
+    model = fit_standards()
+    model.save(path)
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the idf weights used by the similarity stage of evaluate.py.')
+    parser.add_argument('command', choices=['fit'])
+    parser.add_argument('--dataset', action='store_true', help='fit on every full_note of the dataset instead of the current standard notes')
+    parser.add_argument('--path', default=SIMILARITY_MODEL_PATH)
+    args = parser.parse_args()
+    if args.dataset:
+        import dataset
+        model = TfidfModel.fit((record['full_note'] for record in dataset.iter_records(dataset.DATASET_PATH)), DATASET_SOURCE)
+    else:
+        model = fit_standards()
+    model.save(args.path)
+    print(f'Fitted idf on {model.n_docs} notes, {len(model.idf)} terms, version {model.version[:12]} (similarity reports made with other weights are now stale)')
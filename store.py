@@ -0,0 +1,205 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import argparse
+import pandas as pd
+from utils import parse_path, read, ROUGE_REPORT
+import path_index
+
+'''
+Columnar results store. Generated notes, ROUGE scores and LLM judge reports are kept as rows in one SQLite file, indexed by
+(model, prompt) so a whole model/prompt partition is one range scan. Reports are appended as single rows instead of
+rewriting JSON arrays, and loading every ROUGE score for plotting is one query.
+
+    python store.py migrate     # copy the existing results/ tree into the store (notes already in it are skipped)
+    python store.py export      # write the store back out as gen_note.txt / per-type rouge-*.json / ai_eval.json files
+'''
+STORE_PATH = os.path.join('results', 'results.db')
+KEY_COLUMNS = ['root_dir', 'idx', 'model', 'prompt', 'timestamp']
+ROUGE_TYPES = ['rouge-1', 'rouge-2', 'rouge-l']
+
+
+class ResultsStore:
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS notes (
+                root_dir TEXT, idx INTEGER, model TEXT, prompt TEXT, timestamp TEXT,
+                gen_note TEXT, written REAL,
+                PRIMARY KEY (root_dir, idx, model, prompt, timestamp)
+            );
+            CREATE TABLE IF NOT EXISTS rouge (
+                root_dir TEXT, idx INTEGER, model TEXT, prompt TEXT, timestamp TEXT,
+                standard_note_path TEXT, cleaned INTEGER, rouge_type TEXT, r REAL, p REAL, f REAL, written REAL
+            );
+            CREATE TABLE IF NOT EXISTS ai_eval (
+                root_dir TEXT, idx INTEGER, model TEXT, prompt TEXT, timestamp TEXT,
+                standard_note_path TEXT, cleaned INTEGER, judge_model TEXT, added TEXT, missing TEXT, text TEXT, written REAL
+            );
+            CREATE INDEX IF NOT EXISTS notes_partition ON notes (model, prompt, idx);
+            CREATE INDEX IF NOT EXISTS rouge_partition ON rouge (model, prompt, idx, timestamp);
+            CREATE INDEX IF NOT EXISTS ai_eval_partition ON ai_eval (model, prompt, idx, timestamp);
+        ''')
+
+    def key(self, gen_path):
+        path_data = parse_path(gen_path, include_full_path=False)
+        return tuple(path_data[k] for k in KEY_COLUMNS)
+
+    def delete(self, table, gen_path, where='', params=()):
+        self.conn.execute(f'DELETE FROM {table} WHERE root_dir = ? AND idx = ? AND model = ? AND prompt = ? AND timestamp = ?{where}', (*self.key(gen_path), *params))
+
+    def has_note(self, gen_path):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM notes WHERE root_dir = ? AND idx = ? AND model = ? AND prompt = ? AND timestamp = ?', self.key(gen_path)).fetchone() is not None
+
+    def has_rows(self, table, gen_path):
+        '''True if table (e.g. 'rouge' or 'ai_eval') has any row for the note at gen_path.'''
+        with self.lock:
+            return self.conn.execute(f'SELECT 1 FROM {table} WHERE root_dir = ? AND idx = ? AND model = ? AND prompt = ? AND timestamp = ? LIMIT 1', self.key(gen_path)).fetchone() is not None
+
+    def add_note(self, gen_path, gen_note):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?, ?)', (*self.key(gen_path), gen_note, time.time()))
+
+    def add_rouge(self, gen_path, metadata, scores, overwrite=False):
+        '''Appends one row per rouge type of scores ({rouge_type: {'r', 'p', 'f'}}). overwrite replaces earlier rows of those types for the note.'''
+        key = self.key(gen_path)
+        rows = [(*key, metadata['standard_note_path'], metadata['cleaned'], rouge_type, s['r'], s['p'], s['f'], time.time()) for rouge_type, s in scores.items()]
+        with self.lock:
+            self.conn.execute('BEGIN')
+            if overwrite:
+                for rouge_type in scores:
+                    self.delete('rouge', gen_path, ' AND rouge_type = ?', (rouge_type,))
+            self.conn.executemany('INSERT INTO rouge VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.execute('COMMIT')
+
+    def add_ai_eval(self, gen_path, metadata, model_eval, overwrite=False):
+        row = (*self.key(gen_path), metadata['standard_note_path'], metadata['cleaned'], metadata['model'],
+               json.dumps(model_eval['added']), json.dumps(model_eval['missing']), model_eval.get('text'), time.time())
+        with self.lock:
+            self.conn.execute('BEGIN')
+            if overwrite:
+                self.delete('ai_eval', gen_path)
+            self.conn.execute('INSERT INTO ai_eval VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.conn.execute('COMMIT')
+
+    def query(self, table, columns, idxs='all', models='all', prompts='all', extra=None):
+        clauses, params = [], []
+        for column, values in (('model', models), ('prompt', prompts), ('idx', idxs)):
+            if values != 'all':
+                values = values if isinstance(values, list) else [values]
+                clauses.append(f'{column} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        if extra:
+            column, values = extra
+            clauses.append(f'{column} IN ({", ".join("?" * len(values))})')
+            params.extend(values)
+        query = f'SELECT {", ".join(columns)} FROM {table}'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self.lock:
+            return pd.read_sql_query(query + ' ORDER BY rowid', self.conn, params=params)
+
+    def load_rouge(self, idxs='all', models='all', prompts='all', rouge_types=ROUGE_TYPES):
+        '''All matching ROUGE scores in the same long format as utils.get_rouge_report, in one scan.'''
+        df = self.query('rouge', KEY_COLUMNS + ['standard_note_path', 'cleaned', 'rouge_type', 'r', 'p', 'f'], idxs, models, prompts, ('rouge_type', rouge_types))
+        df['cleaned'] = df['cleaned'].astype(bool)
+        df = df.melt(id_vars=KEY_COLUMNS + ['standard_note_path', 'cleaned', 'rouge_type'], value_vars=['r', 'p', 'f'], var_name='metric_type', value_name='score')
+        return df
+
+    def load_ai_eval(self, idxs='all', models='all', prompts='all'):
+        df = self.query('ai_eval', KEY_COLUMNS + ['standard_note_path', 'cleaned', 'judge_model', 'added', 'missing', 'text'], idxs, models, prompts)
+        df['cleaned'] = df['cleaned'].astype(bool)
+        df['added'] = df['added'].map(json.loads)
+        df['missing'] = df['missing'].map(json.loads)
+        df['text'] = df['text'].astype(object).where(df['text'].notna(), None)
+        return df
+
+    def load_notes(self, idxs='all', models='all', prompts='all'):
+        return self.query('notes', KEY_COLUMNS + ['gen_note'], idxs, models, prompts)
+
+    def close(self):
+        self.conn.close()
+
+
+def migrate(store, results_dir='results'):
+    '''
+    Imports every gen_note.txt, rouge.json (or older rouge-*.json) and ai_eval.json under results_dir into store. Notes already in the store are
+    skipped, so running it again only adds new notes. A note's reports replace any rows evaluate.py --store wrote for it
+    before it was migrated, so no report is counted twice.
+    '''
+    counts = {'notes': 0, 'rouge': 0, 'ai_eval': 0, 'skipped': 0}
+    for dirpath, dirnames, filenames in os.walk(results_dir):
+        if 'gen_note.txt' not in filenames:
+            continue
+        gen_path = os.path.join(dirpath, 'gen_note.txt')
+        if store.has_note(gen_path):
+            counts['skipped'] += 1
+            continue
+        if ROUGE_REPORT in filenames:
+            with open(os.path.join(dirpath, ROUGE_REPORT), 'r') as f:
+                for i, report in enumerate(json.load(f)):
+                    store.add_rouge(gen_path, report, {t: report[t] for t in ROUGE_TYPES if t in report}, overwrite=i == 0)
+                    counts['rouge'] += 1
+        for rouge_type in ROUGE_TYPES:
+            if ROUGE_REPORT not in filenames and f'{rouge_type}.json' in filenames:
+                with open(os.path.join(dirpath, f'{rouge_type}.json'), 'r') as f:
+                    for i, report in enumerate(json.load(f)):
+                        store.add_rouge(gen_path, report, {rouge_type: report}, overwrite=i == 0)
+                        counts['rouge'] += 1
+        if 'ai_eval.json' in filenames:
+            with open(os.path.join(dirpath, 'ai_eval.json'), 'r') as f:
+                for i, report in enumerate(json.load(f)):
+                    store.add_ai_eval(gen_path, report, report, overwrite=i == 0)
+                    counts['ai_eval'] += 1
+        # the note row goes in last, so a note whose migration was interrupted is imported again in full
+        store.add_note(gen_path, read(gen_path))
+        counts['notes'] += 1
+    return counts
+
+def export(store, results_dir=None):
+    '''Writes the store back out in the results/{idx}/{model}/{prompt}/{timestamp}/ file layout for tools that still read files.'''
+    def note_dir(row):
+        return os.path.join(results_dir or row['root_dir'], str(row['idx']), row['model'], row['prompt'], row['timestamp'])
+
+    for _, row in store.load_notes().iterrows():
+        os.makedirs(note_dir(row), exist_ok=True)
+        with open(os.path.join(note_dir(row), 'gen_note.txt'), 'w') as f:
+            f.write(row['gen_note'])
+        path_index.record(os.path.join(note_dir(row), 'gen_note.txt'))
+    rouge = store.query('rouge', KEY_COLUMNS + ['standard_note_path', 'cleaned', 'rouge_type', 'r', 'p', 'f'])
+    rouge['cleaned'] = rouge['cleaned'].astype(bool)
+    for (*key, rouge_type), group in rouge.groupby(KEY_COLUMNS + ['rouge_type'], sort=False):
+        path = note_dir(dict(zip(KEY_COLUMNS, key)))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, f'{rouge_type}.json'), 'w') as f:
+            json.dump(group[['standard_note_path', 'cleaned', 'r', 'p', 'f']].to_dict(orient='records'), f, indent=4)
+        path_index.record(os.path.join(path, f'{rouge_type}.json'))
+    ai_eval = store.load_ai_eval()
+    for key, group in ai_eval.groupby(KEY_COLUMNS, sort=False):
+        path = note_dir(dict(zip(KEY_COLUMNS, key)))
+        os.makedirs(path, exist_ok=True)
+        reports = group[['standard_note_path', 'cleaned', 'judge_model', 'added', 'missing', 'text']].rename(columns={'judge_model': 'model'})
+        with open(os.path.join(path, 'ai_eval.json'), 'w') as f:
+            json.dump(reports.to_dict(orient='records'), f, indent=4)
+        path_index.record(os.path.join(path, 'ai_eval.json'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the results/ tree into a results store, or export a store back to files.')
+    parser.add_argument('command', choices=['migrate', 'export'])
+    parser.add_argument('--store', default=STORE_PATH)
+    parser.add_argument('--results-dir', default='results')
+    args = parser.parse_args()
+    store = ResultsStore(args.store)
+    if args.command == 'migrate':
+        print(migrate(store, args.results_dir))
+    else:
+        export(store, args.results_dir)
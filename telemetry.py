@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+'''
+Per-call telemetry for every model backend. Requester.send and Evaluator.compare_documents open a span around each call;
+the span records wall time, time spent queued before the call started, retries, HTTP status, prompt/completion tokens,
+whether the completion cache answered it, time to first token for streamed calls, and an estimated cost from PRICES.
+Records are appended to a JSONL file as they finish, and summary() groups them by backend/model/prompt at the end of a run.
+
+    python telemetry.py summary telemetry/requests.jsonl            # summarize every recorded run
+    python telemetry.py prometheus telemetry/requests.jsonl         # same, as Prometheus text metrics
+'''
+TELEMETRY_DIR = 'telemetry'
+TELEMETRY_PATH = os.path.join(TELEMETRY_DIR, 'requests.jsonl')
+PRICES = { # USD per million tokens: (prompt, completion, cached prompt); models not listed get no cost estimate
+    'o4-mini': (1.10, 4.40, 0.275),
+    'gpt-4.1-mini': (0.40, 1.60, 0.10),
+    'gpt-4o-mini': (0.15, 0.60, 0.075),
+}
+SUMMARY_GROUPS = ['backend', 'model', 'prompt', 'operation']
+
+# context variables rather than thread-locals so concurrent asyncio tasks on one thread each see their own span
+_span = contextvars.ContextVar('telemetry_span', default=None)
+_queued_at = contextvars.ContextVar('telemetry_queued_at', default=None)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    if model not in PRICES or prompt_tokens is None or completion_tokens is None:
+        return None
+    prompt_price, completion_price, cached_price = PRICES[model]
+    cached_tokens = cached_tokens or 0
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price + completion_tokens * completion_price) / 1e6
+
+def current():
+    '''The record of the span open on this thread (or asyncio task), or None.'''
+    return _span.get()
+
+def annotate(**fields):
+    '''Sets fields (tokens, http_status, ...) on the span open on this thread, if any.'''
+    record = current()
+    if record is not None:
+        record.update(fields)
+
+def count(field, n=1):
+    record = current()
+    if record is not None:
+        record[field] = (record.get(field) or 0) + n
+
+def mark_queued(queued_at=None):
+    '''Records when the next call on this thread was queued (time.time()), so its span can report the queue wait.'''
+    _queued_at.set(time.time() if queued_at is None else queued_at)
+
+def span(telemetry, backend, model, prompt, operation='complete'):
+    '''telemetry.span(...) for an optional Telemetry: a no-op context when telemetry is None.'''
+    return nullcontext({}) if telemetry is None else telemetry.span(backend, model, prompt, operation)
+
+
+class Telemetry:
+    def __init__(self, path=TELEMETRY_PATH, run_id=None):
+        '''path is the JSONL file records are appended to, or None to keep them in memory only.'''
+        self.path = path
+        self.run_id = run_id or str(time.time())
+        self.records = []
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, 'a')
+
+    @contextmanager
+    def span(self, backend, model, prompt, operation='complete'):
+        started = time.time()
+        queued_at = _queued_at.get()
+        _queued_at.set(None)
+        record = {
+            'run_id': self.run_id, 'started': started, 'backend': backend, 'model': model, 'prompt': prompt, 'operation': operation,
+            'queue_wait_seconds': started - queued_at if queued_at else None, 'cache_hit': False, 'retries': 0, 'status': 'ok'
+        }
+        token = _span.set(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = repr(e)[:500]
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start
+            if record['cache_hit']:
+                record['cost'] = 0.0
+            else:
+                record['cost'] = estimate_cost(model, record.get('prompt_tokens'), record.get('completion_tokens'), record.get('cached_tokens'))
+            _span.reset(token)
+            self.add(record)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.file is not None:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+
+    def summary(self):
+        return summarize(self.records)
+
+    def write_report(self, directory=TELEMETRY_DIR):
+        '''Writes this run's summary as JSON and Prometheus text next to the JSONL log. Returns the summary.'''
+        summary = self.summary()
+        os.makedirs(directory, exist_ok=True)
+        summary.to_json(os.path.join(directory, f'summary_{self.run_id}.json'), orient='records', indent=4)
+        with open(os.path.join(directory, 'metrics.prom'), 'w') as f:
+            f.write(prometheus(self.records))
+        return summary
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def load(path=TELEMETRY_PATH):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize(records):
+    '''Calls, errors, retries, cache hits, latency percentiles, queue wait, tokens and cost per backend/model/prompt/operation.'''
+    # imported here so every entry point can record spans without loading pandas at startup
+    import numpy as np
+    import pandas as pd
+    columns = SUMMARY_GROUPS + ['calls', 'errors', 'retries', 'cache_hits', 'p50_seconds', 'p95_seconds', 'p50_first_token_seconds', 'mean_queue_wait_seconds',
+                                'prompt_tokens', 'completion_tokens', 'cached_tokens', 'cached_share', 'cost']
+    if not records:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(records)
+    for column in ['prompt_tokens', 'completion_tokens', 'cached_tokens', 'cost', 'queue_wait_seconds', 'first_token_seconds']:
+        if column not in df.columns:
+            df[column] = np.nan
+    df['prompt'] = df['prompt'].fillna('')
+    summary = df.groupby(SUMMARY_GROUPS, dropna=False).agg(
+        calls=('wall_seconds', 'size'),
+        errors=('status', lambda s: int((s == 'error').sum())),
+        retries=('retries', 'sum'),
+        cache_hits=('cache_hit', 'sum'),
+        p50_seconds=('wall_seconds', lambda s: s.quantile(0.5)),
+        p95_seconds=('wall_seconds', lambda s: s.quantile(0.95)),
+        p50_first_token_seconds=('first_token_seconds', lambda s: s.quantile(0.5)),
+        mean_queue_wait_seconds=('queue_wait_seconds', 'mean'),
+        prompt_tokens=('prompt_tokens', 'sum'),
+        completion_tokens=('completion_tokens', 'sum'),
+        cached_tokens=('cached_tokens', lambda s: s.sum(min_count=1)),
+        cost=('cost', lambda s: s.sum(min_count=1))
+    ).reset_index()
+    summary['cached_share'] = summary['cached_tokens'] / summary['prompt_tokens'].where(summary['prompt_tokens'] > 0)
+    return summary[columns]
+
+def prometheus(records):
+    '''Prometheus text exposition of the records: counters per backend/model/prompt and a wall time histogram.'''
+    import numpy as np
+    import pandas as pd
+    buckets = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')]
+    lines = [
+        '# TYPE model_requests_total counter', '# TYPE model_request_errors_total counter', '# TYPE model_request_retries_total counter',
+        '# TYPE model_tokens_total counter', '# TYPE model_cost_usd_total counter', '# TYPE model_request_seconds histogram'
+    ]
+    for row in summarize(records).to_dict(orient='records'):
+        labels = ','.join(f'{k}="{row[k]}"' for k in SUMMARY_GROUPS)
+        lines.append(f'model_requests_total{{{labels}}} {row["calls"]}')
+        lines.append(f'model_request_errors_total{{{labels}}} {row["errors"]}')
+        lines.append(f'model_request_retries_total{{{labels}}} {row["retries"]}')
+        for kind in ['prompt', 'completion', 'cached']:
+            lines.append(f'model_tokens_total{{{labels},kind="{kind}"}} {0 if pd.isna(row[f"{kind}_tokens"]) else int(row[f"{kind}_tokens"])}')
+        if not pd.isna(row['cost']):
+            lines.append(f'model_cost_usd_total{{{labels}}} {row["cost"]}')
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record.get(k) or '' for k in SUMMARY_GROUPS), []).append(record['wall_seconds'])
+    for key, seconds in groups.items():
+        labels = ','.join(f'{k}="{v}"' for k, v in zip(SUMMARY_GROUPS, key))
+        seconds = np.array(seconds)
+        for bucket in buckets:
+            lines.append(f'model_request_seconds_bucket{{{labels},le="{"+Inf" if bucket == float("inf") else bucket}"}} {int((seconds <= bucket).sum())}')
+        lines.append(f'model_request_seconds_sum{{{labels}}} {seconds.sum()}')
+        lines.append(f'model_request_seconds_count{{{labels}}} {len(seconds)}')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize recorded model call telemetry.')
+    parser.add_argument('command', choices=['summary', 'prometheus'])
+    parser.add_argument('path', nargs='?', default=TELEMETRY_PATH)
+    parser.add_argument('--run-id', default=None, help='only this run')
+    args = parser.parse_args()
+    records = [r for r in load(args.path) if args.run_id is None or r['run_id'] == args.run_id]
+    if args.command == 'summary':
+        print(summarize(records).to_string(index=False))
+    else:
+        print(prometheus(records), end='')
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules live at the repository root and evaluate.py reads tools.json from the working directory when imported
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
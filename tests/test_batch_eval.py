@@ -0,0 +1,57 @@
+import json
+import os
+import batch_eval
+from evaluate import Evaluator, MODEL, SYSTEM_PROMPT, TOOLS
+from set_standards import set_standard
+
+FINDING = {'clinical_concept': 'penicillin allergy', 'category': 'allergy', 'severity': 'high', 'confidence': 0.9}
+
+
+def workspace(root):
+    '''One idx with a standard and a generated note under root/results.'''
+    idx_dir = os.path.join(root, 'results', '7')
+    gen_dir = os.path.join(idx_dir, 'ozwell', 'g1', '1700000000.5')
+    os.makedirs(gen_dir)
+    with open(os.path.join(idx_dir, 'full_note.txt'), 'w') as f:
+        f.write('Patient allergic to penicillin. Plan: amoxicillin avoided.')
+    with open(os.path.join(gen_dir, 'gen_note.txt'), 'w') as f:
+        f.write('Plan: amoxicillin.')
+    set_standard(7, os.path.join('results', '7', 'full_note.txt'))
+    return os.path.join('results', '7', 'ozwell', 'g1', '1700000000.5', 'gen_note.txt')
+
+
+def test_local_batch_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    gen_path = workspace(str(tmp_path))
+    evaluator = Evaluator(model=MODEL, system_prompt=SYSTEM_PROMPT, tools=TOOLS)
+    bodies = []
+
+    def responder(body):
+        bodies.append(body)
+        return {'output': [{'type': 'function_call', 'name': 'report_missing_doc', 'arguments': json.dumps(FINDING)}]}
+
+    client = batch_eval.LocalBatchClient(responder)
+    assert batch_eval.run(evaluator, [gen_path], client, batch_dir='batches', poll_interval=0) == {}
+    assert len(bodies) == 1 and bodies[0]['model'] == MODEL
+
+    with open(os.path.join(os.path.dirname(gen_path), 'ai_eval.json')) as f:
+        reports = json.load(f)
+    assert len(reports) == 1
+    assert reports[0]['standard_note_path'] == os.path.join('results', '7', 'full_note.txt')
+    assert reports[0]['missing'] == [FINDING] and reports[0]['added'] == []
+    assert reports[0]['fingerprint'] == evaluator.fingerprint(gen_path, 'llm')
+    # a resumed submit finds the note judged and sends nothing
+    assert batch_eval.submit(evaluator, [gen_path], client, batch_dir='batches', resume=True) == []
+
+
+def test_local_batch_failures_are_reported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    gen_path = workspace(str(tmp_path))
+    evaluator = Evaluator(model=MODEL, system_prompt=SYSTEM_PROMPT, tools=TOOLS)
+
+    def responder(body):
+        raise RuntimeError('rejected')
+
+    failures = batch_eval.run(evaluator, [gen_path], batch_eval.LocalBatchClient(responder), batch_dir='batches', poll_interval=0)
+    assert failures == {gen_path: {'message': 'rejected'}}
+    assert not os.path.exists(os.path.join(os.path.dirname(gen_path), 'ai_eval.json'))
@@ -0,0 +1,47 @@
+import json
+import urllib.error
+import urllib.request
+import pytest
+import bench
+
+LATENCY = {'ozwell': (0.0, 0.0), 'ollama': (0.0, 0.0), 'openai': (0.0, 0.0)}
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def test_mock_server_answers_and_counts():
+    with bench.MockServer(latency=LATENCY, error_rate=0.0) as server:
+        first = post(f'{server.url}/api/v1/completion', {'prompt': 'p', 'systemMessage': 'transcript'})
+        second = post(f'{server.url}/api/v1/completion', {'prompt': 'p', 'systemMessage': 'transcript'})
+        stats = server.stats()
+    assert first == second  # notes are seeded by the request body
+    assert first['choices'][0]['message']['content']
+    assert stats == {'requests': {'ozwell': 2}, 'errors': {}}
+
+
+def test_mock_server_overload():
+    with bench.MockServer(latency=LATENCY, error_rate=1.0) as server:
+        with pytest.raises(urllib.error.HTTPError) as info:
+            post(f'{server.url}/api/generate', {'model': 'm', 'prompt': 'transcript'})
+        stats = server.stats()
+    assert info.value.code == 503 and info.value.headers['Retry-After'] == '0'
+    assert stats['errors'] == {'ollama': 1}
+
+
+def test_benchmark_end_to_end():
+    reports, server_stats, summary = bench.benchmark(notes=3, latency=LATENCY, error_rate=0.2, max_in_flight=2, startup_repeats=0)
+    phases = {report['phase']: report for report in reports}
+    assert set(phases) == {'generate:ozwell', 'generate:ollama', 'generate:ollama-fanout', 'evaluate'}
+    assert all(report['failures'] == 0 for report in reports)
+    assert phases['generate:ollama-fanout']['notes'] == 3 * bench.FANOUT_MODELS
+    assert server_stats['requests']['openai'] >= 3
+
+
+def test_compare_flags_slower_phases():
+    baseline = [{'phase': 'evaluate', 'notes_per_second': 100.0}, {'phase': 'generate:ozwell', 'notes_per_second': 50.0}]
+    reports = [{'phase': 'evaluate', 'notes_per_second': 70.0}, {'phase': 'generate:ozwell', 'notes_per_second': 45.0}, {'phase': 'new', 'notes_per_second': 1.0}]
+    assert bench.compare(reports, baseline, 0.2) == [('evaluate', 100.0, 70.0)]
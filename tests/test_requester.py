@@ -0,0 +1,39 @@
+import pytest
+import bench
+import requester
+from conftest import REPO_DIR
+
+LATENCY = {'ozwell': (0.0, 0.0), 'ollama': (0.0, 0.0), 'openai': (0.0, 0.0)}
+
+
+def ozwell(server, **kwargs):
+    return requester.OzwellRequester('g1', root_dir=REPO_DIR, url=f'{server.url}/api/v1/completion', **kwargs)
+
+
+def test_retry_after_is_honoured():
+    # the mock answers 503 with Retry-After: 0, which must win over the (here very long) exponential backoff
+    with bench.MockServer(latency=LATENCY, error_rate=0.9) as server:
+        client = ozwell(server, max_retries=100, backoff=1000.0, max_backoff=1000.0)
+        delays, retry_delay = [], client.retry_delay
+        client.retry_delay = lambda attempt, retry_after=None: delays.append(retry_delay(attempt, retry_after)) or delays[-1]
+        note = client.send('transcript', use_cache=False)
+        errors = server.httpd.errors['ozwell']
+    assert note
+    assert errors > 0 and delays == [0.0] * errors
+
+
+def test_retry_delay_parses_retry_after():
+    with bench.MockServer(latency=LATENCY, error_rate=0.0) as server:
+        client = ozwell(server, backoff=1.0, max_backoff=60.0)
+    assert client.retry_delay(0, '2') == 2.0
+    assert client.retry_delay(0, '600') == 60.0
+    assert 0.0 <= client.retry_delay(3, 'not a date') <= 8.0
+
+
+def test_retries_exhaust_on_503():
+    with bench.MockServer(latency=LATENCY, error_rate=1.0) as server:
+        with pytest.raises(requester.RetryableError, match='503') as info:
+            ozwell(server, max_retries=3).send('transcript', use_cache=False)
+        requests = server.httpd.requests['ozwell']
+    assert requests == 4
+    assert info.value.retry_after == '0'
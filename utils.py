@@ -1,20 +1,54 @@
-from dotenv import load_dotenv
-import pandas as pd
 import os
-import requester
-from tqdm import tqdm
-from rouge import Rouge
 import json
-import re    
+import re
 from glob import glob
-
+import path_index
+
+# pandas is imported inside the functions that build frames, so path and standard lookups (set_standards, search_file_paths)
+# start without it
+
+
+class StandardsRegistry:
+    '''
+    In-memory map of idx -> standard note path for one standards directory. The symlinks are resolved once and reloaded
+    only when the directory changes (or invalidate() is called, as set_standard does), so lookups are dict hits.
+    '''
+    def __init__(self, standard_dir='standards'):
+        self.standard_dir = standard_dir
+        self.standards = {}
+        self.mtime = None
+
+    def invalidate(self):
+        self.mtime = None
+
+    def refresh(self):
+        mtime = os.stat(self.standard_dir).st_mtime_ns
+        if mtime != self.mtime:
+            self.standards = get_standard_map(self.standard_dir)
+            self.mtime = mtime
+        return self.standards
+
+    def get(self, idx):
+        standards = self.refresh()
+        if int(idx) not in standards:
+            raise FileNotFoundError(f'Standard note for idx {str(idx)} not found in {self.standard_dir}')
+        return standards[int(idx)]
+
+    def get_many(self, idxs):
+        '''Standard paths for many idxs at once (None where an idx has no standard).'''
+        standards = self.refresh()
+        return [standards.get(int(idx)) for idx in idxs]
+
+_STANDARDS_REGISTRIES = {}
+
+def get_standards_registry(standard_dir='standards'):
+    key = os.path.normpath(standard_dir)
+    if key not in _STANDARDS_REGISTRIES:
+        _STANDARDS_REGISTRIES[key] = StandardsRegistry(standard_dir)
+    return _STANDARDS_REGISTRIES[key]
 
 def get_standard_path(idx, standard_dir='standards'):
-    if f'{str(idx)}.txt' in os.listdir(standard_dir):
-        path = os.readlink(os.path.join(standard_dir, f'{str(idx)}.txt'))
-        return path
-    else:
-        raise FileNotFoundError(f'Standard note for idx {str(idx)} not found in {standard_dir}')
+    return get_standards_registry(standard_dir).get(idx)
 
 def arg_to_regex(arg, all_pattern):
     if arg == 'all':
@@ -24,7 +58,11 @@ def arg_to_regex(arg, all_pattern):
     else:
         return str(arg)
     
-def search_file_paths(filename='gen_note.txt', results_dir_path='results', idxs='all', models='all', prompts='all'):
+def search_file_paths(filename='gen_note.txt', results_dir_path='results', idxs='all', models='all', prompts='all', use_index=True):
+    index = path_index.get_index(results_dir_path) if use_index else None
+    if index is not None:
+        index.refresh(results_dir_path, idxs)
+        return [f'{results_dir_path}/{idx}/{model}/{prompt}/{timestamp}/{filename}' for idx, model, prompt, timestamp in index.search(filename, idxs, models, prompts)]
     idxs = arg_to_regex(idxs, r'\d+')
     models = arg_to_regex(models, r'.+')
     prompts = arg_to_regex(prompts, r'g\d+')
@@ -63,6 +101,7 @@ def read(path):
 
 
 def get_metadata_df(paths):
+    import pandas as pd
     notes = list(map(read, paths))
     metadata = list(map(parse_path, paths))
     df = pd.DataFrame.from_records(metadata)
@@ -71,6 +110,7 @@ def get_metadata_df(paths):
 
 
 def write_reports(path, df, overwrite=False):
+    import pandas as pd
     if os.path.exists(path) and not overwrite:
         existing_report = pd.read_json(path)
         pd.concat((existing_report, df)).reset_index(drop=True).to_json(path, orient='records', indent=4)
@@ -79,6 +119,7 @@ def write_reports(path, df, overwrite=False):
 
 
 def melt_rouge_scores(df):
+    import pandas as pd
     rouge_types = [col for col in df.columns if re.match(r'rouge-*', col)]
     other_cols = [col for col in df.columns if col not in rouge_types]
     melted = df.melt(id_vars=other_cols, value_vars=rouge_types)
@@ -101,6 +142,7 @@ def pivot_df(melted_df, pivot_index, aggfunc=None):
 
 
 def get_rouge_report(path):
+    import pandas as pd
     path_data = parse_path(path, False)
     df = pd.read_json(path).melt(id_vars=["standard_note_path", "cleaned"], value_vars=['r', 'p', 'f'], var_name='metric_type', value_name='score')
     rouge_type = path.split('/')[-1].split('.')[0]
@@ -109,6 +151,88 @@ def get_rouge_report(path):
     df = df.loc[:, list(path_data.keys()) + list(df.columns[:-len(path_data)])] # reorder columns
     return df
 
+REPORT_PATH_PATTERN = r'(?P<root_dir>.*)/(?P<idx>\d+)/(?P<model>[^/]+)/(?P<prompt>[^/]+)/(?P<timestamp>\d+\.\d+)/[^/]+\.json$'
+CATEGORY_COLUMNS = ['root_dir', 'idx', 'model', 'prompt', 'timestamp', 'standard_note_path', 'rouge_type', 'metric_type']
+ROUGE_REPORT = 'rouge.json' # a note's ROUGE report: one record per evaluation holding every rouge type's scores
+ROUGE_TYPES = ['rouge-1', 'rouge-2', 'rouge-l']
+
+def categorize(df):
+    '''Stores the repeated label columns of a long score frame as categoricals (groupbys over them should pass observed=True).'''
+    return df.astype({col: 'category' for col in CATEGORY_COLUMNS if col in df.columns})
+
+def rouge_report_rows(path):
+    '''(standard_note_path, cleaned, rouge_type, r, p, f) of every score in a rouge.json report or an older per-type rouge-*.json one.'''
+    with open(path, 'r') as file:
+        reports = json.load(file)
+    name = os.path.basename(path)
+    if name == ROUGE_REPORT:
+        return [(r['standard_note_path'], r['cleaned'], t, r[t]['r'], r[t]['p'], r[t]['f']) for r in reports for t in ROUGE_TYPES if t in r]
+    rouge_type = os.path.splitext(name)[0]
+    return [(r['standard_note_path'], r['cleaned'], rouge_type, r['r'], r['p'], r['f']) for r in reports]
+
+def search_rouge_reports(results_dir_path='results', idxs='all', models='all', prompts='all'):
+    '''The ROUGE reports of the matching notes: each note's rouge.json, or its per-type rouge-*.json files if it has none.'''
+    combined = search_file_paths(ROUGE_REPORT, results_dir_path, idxs, models, prompts)
+    dirs = {os.path.dirname(path) for path in combined}
+    per_type = [path for rouge_type in ROUGE_TYPES for path in search_file_paths(f'{rouge_type}.json', results_dir_path, idxs, models, prompts) if os.path.dirname(path) not in dirs]
+    return combined + per_type
+
+def load_rouge_reports(paths, rouge_types=ROUGE_TYPES):
+    '''
+    Bulk version of get_rouge_report: reads every report (rouge.json or per-type) in one pass and returns a single long frame
+    with the same columns. Path metadata is parsed once per file with vectorized string ops and the label columns are categorical.
+    '''
+    import pandas as pd
+    rows, sources = [], []
+    for path in paths:
+        report_rows = [row for row in rouge_report_rows(path) if row[2] in rouge_types]
+        rows.extend(report_rows)
+        sources.extend([path] * len(report_rows))
+    df = pd.DataFrame.from_records(rows, columns=['standard_note_path', 'cleaned', 'rouge_type', 'r', 'p', 'f'])
+    sources = pd.Series(sources, dtype='category')
+    path_data = sources.cat.categories.to_series().str.extract(REPORT_PATH_PATTERN)
+    path_data['idx'] = path_data['idx'].astype(int)
+    path_data = path_data.iloc[sources.cat.codes].reset_index(drop=True)
+    df = pd.concat((path_data, df), axis=1)
+    df = df.melt(id_vars=['root_dir', 'idx', 'model', 'prompt', 'timestamp', 'standard_note_path', 'cleaned', 'rouge_type'], value_vars=['r', 'p', 'f'], var_name='metric_type', value_name='score')
+    return categorize(df)
+
+def get_standard_map(standard_dir='standards'):
+    '''Resolves every standard symlink in standard_dir once and returns {idx: standard note path}.'''
+    standards = {}
+    with os.scandir(standard_dir) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.txt' and name.isdigit() and entry.is_symlink():
+                standards[int(name)] = os.readlink(entry.path)
+    return standards
+
+def get_most_recent_timestamps(root_dir='results'):
+    '''
+    {(idx, model, prompt): most recent timestamp} for every idx/model/prompt under root_dir, read from its path index when
+    it has one and otherwise from a single os.scandir walk. Either way only timestamp directories holding a gen_note.txt
+    count, so an empty directory left by a failed generation is never the most recent run.
+    '''
+    timestamps = {}
+    index = path_index.get_index(root_dir)
+    if index is not None:
+        index.refresh(root_dir)
+        rows = index.runs('gen_note.txt')
+    else:
+        rows = []
+        for idx_entry in os.scandir(root_dir):
+            if not (idx_entry.is_dir() and idx_entry.name.isdigit()):
+                continue
+            for model_entry in filter(os.DirEntry.is_dir, os.scandir(idx_entry.path)):
+                for prompt_entry in filter(os.DirEntry.is_dir, os.scandir(model_entry.path)):
+                    rows.extend((int(idx_entry.name), model_entry.name, prompt_entry.name, e.name) for e in os.scandir(prompt_entry.path)
+                                if path_index.TIMESTAMP_PATTERN.match(e.name) and os.path.exists(os.path.join(e.path, 'gen_note.txt')))
+    for idx, model, prompt, timestamp in rows:
+        key = (idx, model, prompt)
+        if key not in timestamps or float(timestamp) > float(timestamps[key]):
+            timestamps[key] = timestamp
+    return timestamps
+
 def get_most_recent_timestamp(root_dir, model, prompt, idx):
     path = os.path.join(root_dir, str(idx), model, prompt)
     timestamps = os.listdir(path)